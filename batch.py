@@ -0,0 +1,222 @@
+"""
+Batch post-processing of IV+Spectra measurements from the command line
+
+Finds *_spectra.csv / *IV+photocurrent.csv pairs (or the .npz datasets and .stack directories)
+written by spectra.py and el.py, pairs them by date and sample name, and processes the samples in
+parallel. A measurement saved in several formats is read once, from its .stack, .npz or CSV
+file in that order. Writes one results table per sample and a combined summary, and
+with --profile a JSON file of per-stage timings (see instrument.py).
+
+    python batch.py IV+Spectra/ -o results/ -j 8 --profile timings.json
+
+Does not import Streamlit.
+"""
+
+import argparse
+import glob
+import math
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import calibrations
+import instrument
+import pipeline
+import results_store
+
+
+SPECTRA_SUFFIXES = ('_spectra.csv', '_spectra.npz', '_spectra.stack')
+IV_SUFFIXES = ('IV+photocurrent.csv', 'IV+photocurrent.npz')
+
+# A measurement saved in several formats (the .npz dataset plus its CSV export, and a .stack for
+# long runs) is read from the first of these
+SPECTRA_PREFERENCE = ('_spectra.stack', '_spectra.npz', '_spectra.csv')
+IV_PREFERENCE = ('IV+photocurrent.npz', 'IV+photocurrent.csv')
+
+# Trailing parts of the file names that are not part of the sample name:
+# the sweep range (_0.0V-10.0V) and, for spectra, the integration time (_1.0s)
+_SWEEP_RE = re.compile(r'_(?P<sweep>-?[\d.]+V--?[\d.]+V)(_[\d.e-]+s)?_?$')
+_DATE_RE = re.compile(r'^(?P<date>\d{4}-\d{2}-\d{2})(?P<sample>.*)$')
+
+
+def sample_key(path):
+    """
+    (date, sample, sweep) parsed from a spectra or IV+photocurrent file name,
+    e.g. 2022-05-24Commercial_White1_0.0V-5.0V_1.0s_spectra.csv ->
+    ('2022-05-24', 'Commercial_White1', '0.0V-5.0V'). Missing parts are ''.
+    """
+    name = os.path.basename(path)
+    for suffix in SPECTRA_SUFFIXES + IV_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    sweep = ''
+    m = _SWEEP_RE.search(name)
+    if m:
+        sweep = m.group('sweep')
+        name = name[:m.start()]
+    name = name.rstrip('_')
+    m = _DATE_RE.match(name)
+    if m:
+        return m.group('date'), m.group('sample').strip('_'), sweep
+    return '', name, sweep
+
+
+def preferred(paths, preference):
+    # One path per measurement (same folder and name up to the format suffix), in the
+    # format that comes first in preference
+    best = {}
+    for path in paths:
+        rank, suffix = next((i, s) for i, s in enumerate(preference) if path.endswith(s))
+        stem = path[:-len(suffix)]
+        if stem not in best or rank < best[stem][0]:
+            best[stem] = (rank, path)
+    return sorted(path for _, path in best.values())
+
+
+def discover(directories, recursive=False):
+    # Paired (spectra, iv) paths plus a list of files that could not be paired
+    pattern = os.path.join('**', '*') if recursive else '*'
+    found = []
+    for directory in directories:
+        found.extend(glob.glob(os.path.join(directory, pattern), recursive=recursive))
+    spectra, ivs = {}, {}
+    for path in preferred([p for p in found if p.endswith(SPECTRA_SUFFIXES)], SPECTRA_PREFERENCE):
+        date, sample, sweep = sample_key(path)
+        spectra.setdefault((date, sample), []).append((sweep, path))
+    for path in preferred([p for p in found if p.endswith(IV_SUFFIXES)], IV_PREFERENCE):
+        date, sample, sweep = sample_key(path)
+        ivs.setdefault((date, sample), []).append((sweep, path))
+
+    pairs, unpaired = [], []
+    for key in sorted(set(spectra) | set(ivs)):
+        s_list, iv_list = spectra.get(key, []), ivs.get(key, [])
+        if len(s_list) == 1 and len(iv_list) == 1:
+            pairs.append((key, s_list[0][1], iv_list[0][1]))
+            continue
+        # Several sweeps of the same sample on the same day: pair by sweep range
+        iv_by_sweep = dict(iv_list)
+        for sweep, s_path in s_list:
+            if sweep in iv_by_sweep:
+                pairs.append(((key[0], f'{key[1]}_{sweep}'), s_path, iv_by_sweep.pop(sweep)))
+            else:
+                unpaired.append(s_path)
+        unpaired.extend(iv_by_sweep.values())
+    return pairs, unpaired
+
+
+# Reference tables are read once per worker process
+_tables = None
+_table_files = None
+
+
+def _init_worker(photodiode_file, phototopic_file, trace_memory=False):
+    global _tables, _table_files
+    _tables = calibrations.load(photodiode_file), pipeline.read_phototopic(phototopic_file)
+    _table_files = (photodiode_file, phototopic_file)
+    if trace_memory:
+        instrument.trace_memory()
+
+
+def process_pair(name, spectra_path, iv_path, out_dir, D, A_LED, A_phd, store=None):
+    # store: results store folder (results_store.py) the sweep is added to
+    calibration, phototopic = _tables
+    result = pipeline.compute_metrics(spectra_path, iv_path, calibration, phototopic,
+                                      pipeline.Geometry(D, A_LED, A_phd))
+    result.table.to_csv(os.path.join(out_dir, f'{name}_results.csv'))
+    if store is not None:
+        date, sample, sweep = sample_key(spectra_path)
+        with results_store.ResultsStore(store) as results:
+            results.add(result, sample, date, sweep=sweep, spectra=spectra_path, iv=iv_path,
+                        phototopic=_table_files[1])
+    summary = {'sample': name, 'spectra_file': spectra_path, 'iv_file': iv_path,
+               'calibration': result.calibration['name']}
+    summary.update(pipeline.summarize(result.table))
+    return summary
+
+
+def _run_pair(profile, *args):
+    # process_pair in a worker, with the stage statistics of this sample when profiling
+    if profile:
+        instrument.reset()
+        with instrument.stage('batch.process_pair'):
+            summary = process_pair(*args)
+        return summary, instrument.snapshot()
+    return process_pair(*args), None
+
+
+def write_summary(path, rows):
+    if not rows:
+        return
+    fields = list(rows[0])
+    with open(path, 'w') as f:
+        f.write('\t'.join(fields)+'\n')
+        for row in rows:
+            f.write('\t'.join(_format(row[k]) for k in fields)+'\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return 'nan' if math.isnan(value) else f'{value:.8e}'
+    return str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch QLED post-processing (EQE, luminance, efficacy).')
+    parser.add_argument('directories', nargs='*', default=['IV+Spectra'],
+                        help='folders containing *_spectra.csv and *IV+photocurrent.csv files')
+    parser.add_argument('-o', '--out', default='results', help='output folder')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search sub-folders too')
+    parser.add_argument('--distance', type=float, default=pipeline.DEFAULT_D,
+                        help='distance between photodetector and LED (mm)')
+    parser.add_argument('--led-area', type=float, default=pipeline.DEFAULT_A_LED, help='active area of LED (mm^2)')
+    parser.add_argument('--pd-area', type=float, default=pipeline.DEFAULT_A_PHD,
+                        help='active area of photodetector (mm^2)')
+    parser.add_argument('--photodiode', default=calibrations.DEFAULT,
+                        help=f"photodiode calibration: file or one of {', '.join(calibrations.names())}")
+    parser.add_argument('--phototopic', default=pipeline.PHOTOTOPIC_FILE, help='phototopic function CSV')
+    parser.add_argument('--store', help='also add every sample to this results store folder (results_store.py)')
+    parser.add_argument('--profile', metavar='JSON',
+                        help='write wall time, call counts and peak memory of every stage to this file')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also record peak allocations (tracemalloc, slower)')
+    args = parser.parse_args(argv)
+
+    pairs, unpaired = discover(args.directories, args.recursive)
+    for path in unpaired:
+        print(f'skipping unpaired file: {path}', file=sys.stderr)
+    if not pairs:
+        print('no spectra/IV+photocurrent pairs found', file=sys.stderr)
+        return 1
+
+    os.makedirs(args.out, exist_ok=True)
+    rows, stages, failed = [], {}, 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=_init_worker,
+                             initargs=(args.photodiode, args.phototopic, args.profile_memory)) as pool:
+        futures = {pool.submit(_run_pair, bool(args.profile), f'{date}{sample}', s_path, iv_path, args.out,
+                               args.distance, args.led_area, args.pd_area, args.store): f'{date}{sample}'
+                   for (date, sample), s_path, iv_path in pairs}
+        for future in as_completed(futures):
+            try:
+                row, stats = future.result()
+                rows.append(row)
+                if stats is not None:
+                    stages[futures[future]] = stats
+                print(f'processed {futures[future]}')
+            except Exception as err:
+                failed += 1
+                print(f'failed {futures[future]}: {err}', file=sys.stderr)
+
+    rows.sort(key=lambda row: row['sample'])
+    write_summary(os.path.join(args.out, 'summary.csv'), rows)
+    if args.profile:
+        instrument.to_json(args.profile, instrument.merge(*stages.values()),
+                           samples={name: stages[name] for name in sorted(stages)})
+    print(f'{len(rows)} samples written to {args.out}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Regression check of the vectorized pipeline against the original loops
+
+benchmarks/reference/Commercial_White1_loop.npz holds C, K and the
+per-voltage table (V, I, Iphd, photon flux, radiance, EQE, J, luminous
+intensity, luminance, current and luminous efficacy) that the per-voltage,
+per-bin loops of the original QLED_postprocessing.py computed for the default
+Commercial_White1 files at the default geometry. The same quantities are
+computed with pipeline.compute_metrics and compared to a relative tolerance
+(differences are summation order only). Exits with status 1 on a mismatch.
+
+    python benchmarks/check_reference.py
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference', 'Commercial_White1_loop.npz')
+RTOL = 1e-12
+
+
+def compare(name, values, expected, rtol=RTOL):
+    # (ok, largest relative difference) of values against expected; NaN must match NaN
+    ok = np.allclose(values, expected, rtol=rtol, atol=0, equal_nan=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative = np.abs(values - expected)/np.abs(expected)
+    worst = float(np.nanmax(relative[np.isfinite(relative)], initial=0.0))
+    print(f'{name}: max relative difference {worst:.2e} [{"ok" if ok else "MISMATCH"}]')
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the pipeline with the reference values of the original loops.')
+    parser.add_argument('--rtol', type=float, default=RTOL, help='relative tolerance')
+    args = parser.parse_args(argv)
+
+    with np.load(REFERENCE) as f:
+        reference = {name: f[name] for name in f.files}
+    result = pipeline.compute_metrics(pipeline.DEFAULT_SPECTRA_FILE, pipeline.DEFAULT_IV_FILE)
+    n = len(reference['Cs'])
+    ok = compare('Cs', result.spectral.Cs[:n], reference['Cs'], args.rtol)
+    ok &= compare('Ks', result.spectral.Ks[:n], reference['Ks'], args.rtol)
+    for i, name in enumerate(reference['names']):
+        ok &= compare(str(name), result.table[str(name)], reference['table'][:, i], args.rtol)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Import-time budget of every entry point
+
+Each entry point is imported in a fresh interpreter (so nothing is already
+in sys.modules) and timed against its budget: the wall time of the import
+on top of an empty interpreter start, best of several runs. The modules it
+loaded are checked against those it must never load: the headless compute
+path (pipeline, batch.py, watch.py, lifetime.py, results_store.py) must not
+pull in Streamlit, IPython, the instrument drivers, matplotlib or pandas,
+and the Streamlit pages only load the instrument drivers once a sweep is
+run. The heaviest imports (python -X importtime) are listed for each entry.
+
+Entry points whose own dependencies are not installed (Streamlit on a
+processing-only machine) are reported as skipped.
+
+    python benchmarks/import_times.py --check -o imports.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DRIVERS = ('IPython', 'pyvisa', 'seabreeze')
+HEADLESS = ('streamlit', 'matplotlib', 'pandas') + DRIVERS
+
+# Entry point -> (budget in s, modules it must not load)
+ENTRY_POINTS = {
+    'pipeline': (0.3, HEADLESS),
+    'batch': (0.3, HEADLESS),
+    'watch': (0.3, HEADLESS),
+    'lifetime': (0.3, HEADLESS),
+    'results_store': (0.3, HEADLESS),
+    'figures': (1.5, ('streamlit',) + DRIVERS),
+    'spectra': (1.0, DRIVERS),
+    'el': (1.0, DRIVERS),
+    'QLED_postprocessing': (2.0, DRIVERS),
+}
+
+# Run in the child: import the entry point, then report what it loaded
+_PROBE = 'import sys, json; import {module}; print(json.dumps(sorted(sys.modules)))'
+
+
+def _run(code, importtime=False):
+    flags = ['-X', 'importtime'] if importtime else []
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, *flags, '-c', code], cwd=HERE, capture_output=True, text=True)
+    return time.perf_counter() - start, proc
+
+
+def heaviest(stderr, count=5):
+    # Imports made directly by the entry point with the largest cumulative time, from python -X importtime
+    # (one line per module, nested imports indented by two spaces and listed before their parent)
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        if len(name) - len(name.lstrip()) == 3:
+            rows.append((int(fields[1]), name.strip()))
+    return [{'module': name, 'cumulative_ms': us/1000} for us, name in sorted(rows, reverse=True)[:count]]
+
+
+def measure(module, budget, forbidden, baseline, repeat):
+    times, proc = [], None
+    for _ in range(repeat):
+        elapsed, proc = _run(_PROBE.format(module=module))
+        if proc.returncode != 0:
+            break
+        times.append(elapsed - baseline)
+    row = {'entry': module, 'budget_s': budget}
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        error = lines[-1] if lines else f'exit status {proc.returncode}'
+        row.update(status='skipped' if 'ModuleNotFoundError' in error else 'error', error=error)
+        return row
+    loaded = set(json.loads(proc.stdout.strip().splitlines()[-1]))
+    _, traced = _run(_PROBE.format(module=module), importtime=True)
+    bad = sorted(name for name in forbidden if name in loaded)
+    row.update(best_s=min(times), mean_s=sum(times)/len(times), forbidden_loaded=bad, heaviest=heaviest(traced.stderr),
+               status='ok' if min(times) <= budget and not bad else 'over')
+    return row
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the imports of every entry point against its budget.')
+    parser.add_argument('entries', nargs='*', default=list(ENTRY_POINTS), help='entry points to time')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='imports per entry point (best and mean reported)')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 if any entry is over its budget')
+    parser.add_argument('-o', '--out', default='-', help='JSON output file (- for stdout)')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.entries if name not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+    # Interpreter start-up alone, subtracted from every timing
+    baseline = min(_run('pass')[0] for _ in range(max(1, args.repeat)))
+    rows = []
+    for name in args.entries:
+        budget, forbidden = ENTRY_POINTS[name]
+        row = measure(name, budget, forbidden, baseline, max(1, args.repeat))
+        rows.append(row)
+        if 'best_s' in row:
+            note = f" loads {', '.join(row['forbidden_loaded'])}" if row['forbidden_loaded'] else ''
+            print(f"{name}: {row['best_s']*1000:.0f} ms of {budget*1000:.0f} ms{note} [{row['status']}]", file=sys.stderr)
+        else:
+            print(f"{name}: {row['status']} ({row['error']})", file=sys.stderr)
+
+    report = json.dumps({'environment': environment(), 'baseline_s': baseline, 'results': rows}, indent=1)
+    if args.out == '-':
+        print(report)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(report + '\n')
+    return 1 if args.check and any(row['status'] in ('over', 'error') for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
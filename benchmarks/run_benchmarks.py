@@ -0,0 +1,194 @@
+"""
+Per-stage timings of the post-processing pipeline on synthetic data
+
+For every combination of voltage count and spectrometer bins a synthetic
+sample is generated (benchmarks/synthetic.py) and each stage is timed on its
+own: parsing, calibration resampling, spectral integrals, derived metrics,
+plotting and export, plus the end-to-end compute_metrics and batch.py over
+several samples. Results are written as JSON so runs can be compared over
+time.
+
+    python benchmarks/run_benchmarks.py --volts 51 201 --bins 2048 4096 --samples 8 -o bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch
+import calibrations
+import dataset
+import figures
+import interp_index
+import pipeline
+import spectral_engine
+import synthetic
+
+
+# Graphs timed in the plotting stage, with the app's default options
+PLOTS = {
+    'graph3': (True, 0.0, 0.0),
+    'graph12': ('linear', 0.0, 0.0, 0.0, 0.0),
+    'graph26': ('log', 'log', 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
+    'graph30': (5, True, 0.0, 0.0),
+}
+
+
+def timed(fn, repeat):
+    # (last return value, list of wall times in s)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - start)
+    return value, times
+
+
+def record(stage, times, **params):
+    return dict(params, stage=stage, repeat=len(times), best_s=min(times), mean_s=float(np.mean(times)))
+
+
+def clear_caches(work_dir, indices=True):
+    # Empty the calibration registry's caches (parsed files, QE on spectrometer grids) and, with
+    # indices, the interpolation indices, and point the on-disk cache at an empty folder
+    calibrations._parsed.clear()
+    calibrations._on_grid.clear()
+    if indices:
+        interp_index._memory.clear()
+    os.environ['QLED_CACHE_DIR'] = tempfile.mkdtemp(dir=work_dir)
+
+
+def bench_sample(work_dir, nvolts, nbins, repeat, plots=True):
+    params = {'nvolts': nvolts, 'nbins': nbins}
+    spectra_path, iv_path = synthetic.make_samples(work_dir, 1, nvolts, nbins)[0]
+    rows = []
+
+    def parse():
+        return pipeline.read_spectra(spectra_path), pipeline.read_iv(iv_path)
+    (Spectra, IV), times = timed(parse, repeat)
+    rows.append(record('parse', times, **params))
+
+    def calibration():
+        # cold: parse the reference tables (the default calibration through the registry, as the
+        # pipeline does) and resample them from scratch, with every cache emptied
+        clear_caches(work_dir)
+        photodiode_data, phototopic = pipeline.read_reference_tables(calibrations.DEFAULT)
+        wavelengths = Spectra[:, 0]
+        calibrations.detector_qe_on_grid(wavelengths, photodiode_data)
+        spectral_engine.phototopic_on_grid(wavelengths, phototopic)
+        return photodiode_data, phototopic
+    (photodiode_data, phototopic), times = timed(calibration, repeat)
+    rows.append(record('calibration_resample', times, **params))
+
+    spectral, times = timed(lambda: pipeline.spectral_stage(Spectra, photodiode_data, phototopic), repeat)
+    rows.append(record('spectral_integrals', times, **params))
+
+    geometry = pipeline.Geometry()
+    table, times = timed(lambda: pipeline.geometry_stage(spectral, IV, geometry), repeat)
+    rows.append(record('derived_metrics', times, **params))
+
+    def compute_metrics():
+        # End to end, including parsing the calibration (the interpolation indices stay warm)
+        clear_caches(work_dir, indices=False)
+        return pipeline.compute_metrics(spectra_path, iv_path)
+    _, times = timed(compute_metrics, repeat)
+    rows.append(record('compute_metrics', times, **params))
+
+    result = pipeline.Result(spectral, table, geometry)
+    if plots:
+        for graph_id, options in PLOTS.items():
+            _, times = timed(lambda: figures.render(figures.draw(graph_id, result, 'Synthetic', options)), repeat)
+            rows.append(record(f'plot_{graph_id}', times, **params))
+
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+
+    def export_tables():
+        result.table.to_csv(os.path.join(out_dir, 'results.csv'))
+        dataset.save_dataset(os.path.join(out_dir, 'results.npz'), dataset.from_result(result))
+    _, times = timed(export_tables, repeat)
+    rows.append(record('export_tables', times, **params))
+
+    if plots:
+        jobs = [(graph_id, options, os.path.join(out_dir, f'{graph_id}.png')) for graph_id, options in PLOTS.items()]
+        figures.export_figures(result, 'Synthetic', jobs[:1])[0].result()   # start the pool outside the timing
+
+        def export_figures():
+            figures._exported.clear()
+            for future in figures.export_figures(result, 'Synthetic', jobs):
+                future.result()
+        _, times = timed(export_figures, repeat)
+        rows.append(record('export_figures', times, **params))
+    return rows
+
+
+def bench_batch(work_dir, samples, nvolts, nbins, jobs):
+    data_dir = os.path.join(work_dir, f'batch_{samples}_{nvolts}_{nbins}')
+    synthetic.make_samples(data_dir, samples, nvolts, nbins)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            batch.main([data_dir, '-o', os.path.join(data_dir, 'results'), '-j', str(jobs)])
+        finally:
+            sys.stdout = stdout
+    return record('batch', [time.perf_counter() - start], nvolts=nvolts, nbins=nbins, samples=samples, jobs=jobs)
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=pipeline.HERE, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the post-processing stages on synthetic data.')
+    parser.add_argument('--volts', type=int, nargs='+', default=[51], help='voltage points per sweep')
+    parser.add_argument('--bins', type=int, nargs='+', default=[2048], help='spectrometer bins')
+    parser.add_argument('--samples', type=int, default=4, help='samples for the batch.py timing (0 to skip)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='batch.py worker processes')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions per stage (best and mean reported)')
+    parser.add_argument('--no-plots', action='store_true', help='skip the plotting and figure export stages')
+    parser.add_argument('-o', '--out', default='-', help='JSON output file (- for stdout)')
+    args = parser.parse_args(argv)
+
+    figures.plot_style()
+    rows = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_env = os.environ.get('QLED_CACHE_DIR')
+        try:
+            for nvolts in args.volts:
+                for nbins in args.bins:
+                    rows.extend(bench_sample(work_dir, nvolts, nbins, args.repeat, not args.no_plots))
+                    if args.samples:
+                        rows.append(bench_batch(work_dir, args.samples, nvolts, nbins, args.jobs))
+                    print(f'{nvolts} voltages x {nbins} bins done', file=sys.stderr)
+        finally:
+            if cache_env is None:
+                os.environ.pop('QLED_CACHE_DIR', None)
+            else:
+                os.environ['QLED_CACHE_DIR'] = cache_env
+
+    report = json.dumps({'environment': environment(), 'results': rows}, indent=1)
+    if args.out == '-':
+        print(report)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(report + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Synthetic spectra and IV+photocurrent files for benchmarking
+
+The default 2022-05-24 Commercial_White1 measurement is used as a template:
+the emission shape of its brightest spectrum is resampled onto a grid of the
+requested size, scaled at every voltage by the measured peak counts, and
+given shot-like noise; the IV and photocurrent curves are resampled onto the
+requested number of voltages. Files are written with the names and formats of
+spectra.py and el.py, so batch.py and the app read them like real data.
+
+    python benchmarks/synthetic.py out/ --samples 10 --volts 201 --bins 4096
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dataset
+import pipeline
+
+
+TEMPLATE_SPECTRA = os.path.join(pipeline.HERE, '2022-05-24Commercial_White1_spectra.csv')
+TEMPLATE_IV = os.path.join(pipeline.HERE, '2022-05-24Commercial_White1IV+photocurrent.csv')
+
+_template = None
+
+
+def template():
+    # (wavelengths, emission shape with max 1, V, peak counts per voltage, IV matrix) of the template
+    global _template
+    if _template is None:
+        Spectra = pipeline.read_spectra(TEMPLATE_SPECTRA)
+        IV = pipeline.read_iv(TEMPLATE_IV)
+        peaks = np.amax(Spectra[:, 1:], axis=0)
+        shape = Spectra[:, 1+np.argmax(peaks)]/np.amax(peaks)
+        _template = (Spectra[:, 0], shape, IV[:, 0], peaks[:len(IV)], IV)
+    return _template
+
+
+def make_sample(nvolts=51, nbins=2048, seed=0, noise=2.0):
+    """
+    Spectra (nbins, 1+nvolts) and IV (nvolts, 3) matrices over the voltage
+    range of the template. noise is the standard deviation of the counts
+    added to every bin; negative counts are clipped as the spectrometer
+    background subtraction does.
+    """
+    rng = np.random.default_rng(seed)
+    wavelengths_t, shape_t, V_t, peaks_t, IV_t = template()
+
+    wavelengths = np.linspace(wavelengths_t[0], wavelengths_t[-1], nbins)
+    # a small random peak shift so samples are not identical
+    shift = rng.normal(scale=2.0)
+    shape = np.interp(wavelengths - shift, wavelengths_t, shape_t)
+
+    V = np.linspace(V_t[0], V_t[-1], nvolts)
+    peaks = np.interp(V, V_t, peaks_t)
+    counts = shape[:, None]*peaks[None, :]
+    counts += rng.normal(scale=noise, size=counts.shape)*(peaks > 0)
+    Spectra = np.column_stack([wavelengths, np.maximum(counts, 0.0)])
+
+    IV = np.column_stack([V] + [np.interp(V, V_t, IV_t[:, i]) for i in (1, 2)])
+    return Spectra, IV
+
+
+def write_sample(out_dir, name, Spectra, IV, format='csv'):
+    # Files named like spectra.py / el.py output; returns (spectra_path, iv_path)
+    os.makedirs(out_dir, exist_ok=True)
+    start, stop = IV[0, 0], IV[-1, 0]
+    stem = os.path.join(out_dir, f'{name}_{start}V-{stop}V')
+    if format == 'npz':
+        spectra_path = dataset.save_dataset(f'{stem}_1.0s_spectra.npz', dataset.Dataset(
+            {'wavelengths': Spectra[:, 0], 'intensities': Spectra[:, 1:], 'spectra_voltages': IV[:, 0]}))
+        iv_path = dataset.save_dataset(f'{stem}_IV+photocurrent.npz', dataset.Dataset(
+            {'voltage': IV[:, 0], 'current': IV[:, 1], 'photocurrent': IV[:, 2]}))
+        return spectra_path, iv_path
+
+    spectra_path = f'{stem}_1.0s_spectra.csv'
+    iv_path = f'{stem}_IV+photocurrent.csv'
+    header = 'Wavelengths(nm)' + ''.join(f'\t{v}V' for v in IV[:, 0])
+    np.savetxt(spectra_path, Spectra, fmt='%.18e', delimiter='\t', newline='\n', header=header,
+               footer='Integration Time (ms) = 1000')
+    np.savetxt(iv_path, IV, fmt='%.18e', delimiter='\t', newline='\n',
+               header='Bias(V)\tCurrent(mA)\tPhotocurrent(mA)')
+    return spectra_path, iv_path
+
+
+def make_samples(out_dir, samples=1, nvolts=51, nbins=2048, format='csv', seed=0):
+    # Write several synthetic samples; returns their (spectra_path, iv_path) pairs
+    paths = []
+    for i in range(samples):
+        Spectra, IV = make_sample(nvolts, nbins, seed=seed+i)
+        paths.append(write_sample(out_dir, f'2000-01-01Synthetic{i}', Spectra, IV, format))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic spectra/IV+photocurrent files.')
+    parser.add_argument('out', help='output folder')
+    parser.add_argument('--samples', type=int, default=1, help='number of samples')
+    parser.add_argument('--volts', type=int, default=51, help='voltage points per sweep')
+    parser.add_argument('--bins', type=int, default=2048, help='spectrometer bins')
+    parser.add_argument('--format', choices=('csv', 'npz'), default='csv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    for spectra_path, iv_path in make_samples(args.out, args.samples, args.volts, args.bins, args.format, args.seed):
+        print(spectra_path)
+        print(iv_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
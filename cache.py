@@ -0,0 +1,149 @@
+"""
+Small caching helpers shared by the post-processing modules
+
+LRUCache is a bounded in-memory mapping and content_hash() keys it on the
+contents of files and arrays; cache_dir() and prune_dir() manage the on-disk
+cache (default ~/.cache/qled, override with QLED_CACHE_DIR).
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def cache_dir(*parts):
+    # On-disk cache directory, created on first use
+    root = os.environ.get('QLED_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'qled'))
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def array_hash(*arrays):
+    # Hash of the dtype, shape and contents of one or more arrays
+    digest = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        digest.update(str(a.dtype).encode())
+        digest.update(str(a.shape).encode())
+        digest.update(a.tobytes())
+    return digest.hexdigest()
+
+
+def prune_dir(path, max_files, suffix=''):
+    # Keep at most max_files entries in path, dropping the least recently used
+    # (files are touched on every read, so mtime tracks last use).
+    entries = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(suffix)]
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda p: os.stat(p).st_mtime)
+    for p in entries[:len(entries)-max_files]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def content_hash(source):
+    """
+    Hash of the contents of a path, an uploaded/in-memory file, raw bytes or
+    an array. Hashes of paths are remembered while the file's size and
+    modification time stay the same; directories are keyed on the names,
+    sizes and modification times of their files.
+    """
+    if isinstance(source, np.ndarray):
+        return array_hash(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha1(source).hexdigest()
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        # Directories (memory-mapped stacks) are keyed on their listing, not hashed byte by byte
+        digest = hashlib.sha1(os.path.abspath(source).encode())
+        for entry in sorted(os.scandir(source), key=lambda entry: entry.name):
+            st = entry.stat()
+            digest.update(f'{entry.name}:{st.st_size}:{st.st_mtime_ns};'.encode())
+        return digest.hexdigest()
+    if hasattr(source, 'path') and hasattr(source, 'intensities'):
+        return content_hash(source.path)
+    if hasattr(source, 'digest') and hasattr(source, 'provenance'):
+        # calibrations.Calibration: already keyed on its file's contents
+        return source.digest
+    if isinstance(source, (str, os.PathLike)):
+        st = os.stat(source)
+        key = (os.path.abspath(source), st.st_size, st.st_mtime_ns)
+        digest = _path_hashes.get(key)
+        if digest is None:
+            digest = hashlib.sha1()
+            with open(source, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            digest = digest.hexdigest()
+            _path_hashes.put(key, digest)
+        return digest
+    if hasattr(source, 'getvalue'):
+        # Streamlit UploadedFile, BytesIO, StringIO
+        data = source.getvalue()
+    else:
+        position = source.tell()
+        data = source.read()
+        source.seek(position)
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe mapping that keeps at most maxsize entries (and, if maxbytes
+    is given, at most maxbytes as measured by sizeof), evicting the least
+    recently used entries first.
+    """
+
+    def __init__(self, maxsize=32, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._sizes.pop(key)
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self.nbytes += size
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes is not None and self.nbytes > self.maxbytes and len(self._data) > 1):
+                old, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+_path_hashes = LRUCache(256)
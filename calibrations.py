@@ -0,0 +1,185 @@
+"""
+Registry of photodiode calibrations
+
+Names the detector calibrations that can be used for a run (the
+PhotodiodeE_000.qsdat export and the Si_Diode_MZ_000.txt table shipped with
+the app, plus any registered with register()), parses each one once, and
+records its provenance: the date, CalibrationFile and Comment (e.g.
+'340-1200nm, Z=8.83; OD=1') of the .qsdat header and the content hash.
+
+Parsed calibrations and their QE resampled onto spectrometer grids are
+cached in memory and on disk (cache.cache_dir('calibration')), keyed on
+content, so switching detectors or restarting doesn't re-parse the files.
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+
+import qsdat
+import spectral_engine
+from cache import LRUCache, array_hash, cache_dir, content_hash, prune_dir
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Name -> calibration file
+REGISTRY = {
+    'PhotodiodeE_000': os.path.join(HERE, 'PhotodiodeE_000.qsdat'),
+    'Si_Diode_MZ_000': os.path.join(HERE, 'Si_Diode_MZ_000.txt'),
+}
+DEFAULT = 'PhotodiodeE_000'
+
+MEMORY_ENTRIES = 16
+DISK_ENTRIES = 64
+
+_parsed = LRUCache(MEMORY_ENTRIES)
+_on_grid = LRUCache(MEMORY_ENTRIES)
+
+# 'Z=8.83; OD=1' -> {'Z': '8.83', 'OD': '1'}
+_SETTING_RE = re.compile(r'([A-Za-z]+)\s*=\s*([^;,\s]+)')
+
+
+class Calibration:
+    """
+    Parsed photodiode calibration.
+
+    name: registry name (or file name)
+    data: (nrows, ncolumns) table: wavelength (nm), voltage, EQE (%), SR (A/W), ...
+    digest: content hash of the file
+    provenance: dict recorded with every result (name, file, hash, date,
+                calibration_file, comment and the settings parsed from it)
+    """
+
+    def __init__(self, name, data, digest, provenance):
+        self.name = name
+        self.data = data
+        self.digest = digest
+        self.provenance = provenance
+
+    def detector_qe(self, wavelengths):
+        return detector_qe_on_grid(wavelengths, self.data)
+
+
+def register(name, path):
+    REGISTRY[name] = os.fspath(path)
+
+
+def names():
+    return list(REGISTRY)
+
+
+def resolve(source):
+    # File of a registry name; anything else is returned as it is
+    if isinstance(source, str) and source in REGISTRY:
+        return REGISTRY[source]
+    return source
+
+
+def parse_settings(comment):
+    return dict(_SETTING_RE.findall(comment or ''))
+
+
+def _provenance(name, source, digest, parsed):
+    header = parsed.header
+    comment = header.get('Comment', '')
+    record = {'name': name, 'file': _file_name(source), 'hash': digest, 'date': header.get('Date', ''),
+              'calibration_file': header.get('CalibrationFile', ''), 'comment': comment}
+    record.update(parse_settings(comment))
+    return record
+
+
+def _file_name(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.basename(os.fspath(source))
+    return getattr(source, 'name', '') or ''
+
+
+def load(source=DEFAULT):
+    """
+    Calibration for a registry name, a path or an uploaded file, from the
+    memory cache, then the disk cache, parsing the file only on a miss.
+    """
+    if isinstance(source, Calibration):
+        return source
+    name = source if isinstance(source, str) and source in REGISTRY else None
+    source = resolve(source)
+    if name is None:
+        name = os.path.splitext(_file_name(source))[0]
+    digest = content_hash(source)
+    calibration = _parsed.get(digest)
+    if calibration is not None:
+        return calibration
+
+    path = os.path.join(cache_dir('calibration'), digest+'.npz')
+    if os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                calibration = Calibration(name, f['data'], digest, json.loads(str(f['provenance'])))
+            calibration.provenance['name'] = name
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            calibration = None
+
+    if calibration is None:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        parsed = qsdat.read_calibration(source)
+        calibration = Calibration(name, parsed.data, digest, _provenance(name, source, digest, parsed))
+        # A read-only or full disk only costs the persistent copy
+        try:
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as fh:
+                np.savez(fh, data=calibration.data, provenance=np.array(json.dumps(calibration.provenance)))
+            os.replace(tmp, path)
+            prune_dir(os.path.dirname(path), DISK_ENTRIES, suffix='.npz')
+        except OSError:
+            pass
+
+    _parsed.put(digest, calibration)
+    return calibration
+
+
+def provenance(source):
+    # Provenance record of a calibration given in any form the pipeline accepts
+    if isinstance(source, np.ndarray):
+        return {'name': '', 'file': '', 'hash': array_hash(source)}
+    if isinstance(source, qsdat.QsdatFile):
+        return _provenance('', '', array_hash(source.data), source)
+    return dict(load(source).provenance)
+
+
+def detector_qe_on_grid(wavelengths, photodiode_data):
+    """
+    Photodiode QE (fraction) on the spectrometer grid, as
+    spectral_engine.detector_qe_on_grid, cached in memory and on disk for
+    each (calibration, grid) pair.
+    """
+    key = array_hash(np.asarray(photodiode_data, dtype=float), np.asarray(wavelengths, dtype=float))
+    qe = _on_grid.get(key)
+    if qe is not None:
+        return qe
+
+    path = os.path.join(cache_dir('calibration', 'grid'), key+'.npy')
+    if os.path.exists(path):
+        try:
+            qe = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            qe = None
+
+    if qe is None:
+        qe = spectral_engine.detector_qe_on_grid(wavelengths, photodiode_data)
+        try:
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as fh:
+                np.save(fh, qe)
+            os.replace(tmp, path)
+            prune_dir(os.path.dirname(path), DISK_ENTRIES, suffix='.npy')
+        except OSError:
+            pass
+
+    _on_grid.put(key, qe)
+    return qe
@@ -0,0 +1,172 @@
+"""
+Batched CIE 1931 colorimetry of the EL spectra
+
+The colour-matching functions are resampled onto the spectrometer grid once
+(and cached per grid) as a (3, nbins) weight matrix, so the tristimulus
+values of every voltage column are a single matrix product. Chromaticity
+(xy, u'v'), correlated colour temperature and dominant wavelength follow
+element-wise on the (3, nspectra) result.
+
+CIE1931_2deg_CMF.csv holds the CIE 1931 2 degree standard observer at its
+full 1 nm tabulation, 360-830 nm (wavelength, xbar, ybar, zbar); another
+table in the same format can be passed wherever cmf is accepted. A coarser
+table interpolated onto the grid is not enough for narrow QLED emission: the
+10 nm one shifts x and y by up to about 1e-3 on the default dataset.
+"""
+
+import os
+
+import numpy as np
+
+from cache import LRUCache, array_hash
+
+
+CMF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CIE1931_2deg_CMF.csv')
+
+# Reference white for the dominant wavelength (CIE D65)
+WHITE_D65 = (0.3127, 0.3290)
+
+# CCT is only reported within this distance of the Planckian locus (CIE 1960 uv)
+MAX_DUV = 0.05
+
+_tables = LRUCache(4)
+_weights = LRUCache(16)
+_loci = LRUCache(4)
+
+
+def load_cmf(source=CMF_FILE):
+    # (n, 4) array of wavelength [nm], xbar, ybar, zbar
+    cmf = _tables.get(source) if isinstance(source, str) else None
+    if cmf is None:
+        import pandas as pd
+        cmf = pd.read_csv(source, header=None, comment='#').to_numpy(dtype=float)[:, :4]
+        if isinstance(source, str):
+            _tables.put(source, cmf)
+    return cmf
+
+
+def cmf_on_grid(wavelengths, cmf=None):
+    # (3, nbins) colour-matching functions on the spectrometer grid, zero outside the table
+    cmf = load_cmf() if cmf is None else cmf
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    return np.vstack([np.interp(wavelengths, cmf[:, 0], cmf[:, i], left=0.0, right=0.0) for i in (1, 2, 3)])
+
+
+def cmf_weights(wavelengths, cmf=None):
+    """
+    (3, nbins) matrix W such that W @ spectra gives X, Y, Z: the colour-
+    matching functions times the width of each bin (trapezoidal rule, so
+    non-uniform grids are handled). Cached per grid and table.
+    """
+    cmf = load_cmf() if cmf is None else cmf
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    key = array_hash(wavelengths, cmf)
+    W = _weights.get(key)
+    if W is None:
+        widths = np.zeros(len(wavelengths))
+        steps = np.diff(wavelengths)
+        widths[:-1] += steps/2
+        widths[1:] += steps/2
+        W = cmf_on_grid(wavelengths, cmf)*widths
+        _weights.put(key, W)
+    return W
+
+
+def tristimulus(wavelengths, spectra, cmf=None):
+    # (3, nspectra) X, Y, Z of every spectrum column (relative scale, counts)
+    return cmf_weights(wavelengths, cmf) @ np.asarray(spectra, dtype=float)
+
+
+def tristimulus_chunked(wavelengths, chunks, nspectra, cmf=None):
+    # tristimulus for spectra handed out in (start, block) chunks, e.g. SpectralStack.iter_chunks()
+    W = cmf_weights(wavelengths, cmf)
+    XYZ = np.empty((3, nspectra))
+    for start, block in chunks:
+        XYZ[:, start:start+block.shape[1]] = W @ block
+    return XYZ
+
+
+def chromaticity(XYZ):
+    # CIE 1931 x, y and CIE 1976 u', v' from (3, n) tristimulus values; NaN for dark spectra
+    X, Y, Z = XYZ
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = X + Y + Z
+        denominator = X + 15*Y + 3*Z
+        return X/total, Y/total, 4*X/denominator, 9*Y/denominator
+
+
+def planckian_uv(T):
+    # CIE 1960 u, v of a black body at T [K] (Krystek 1985, 1000 K to 15000 K)
+    T = np.asarray(T, dtype=float)
+    u = (0.860117757 + 1.54118254e-4*T + 1.28641212e-7*T*T)/(1 + 8.42420235e-4*T + 7.08145163e-7*T*T)
+    v = (0.317398726 + 4.22806245e-5*T + 4.20481691e-8*T*T)/(1 - 2.89741816e-5*T + 1.61456053e-7*T*T)
+    return u, v
+
+
+def cct(x, y, u_prime, v_prime, max_duv=MAX_DUV):
+    """
+    Correlated colour temperature [K] (McCamy 1992). NaN where the colour is
+    further than max_duv from the Planckian locus, e.g. for saturated
+    single-colour emitters, where a colour temperature has no meaning.
+    """
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        n = (x - 0.3320)/(0.1858 - y)
+        T = ((449.0*n + 3525.0)*n + 6823.3)*n + 5520.33
+        u, v = planckian_uv(T)
+        duv = np.hypot(u_prime - u, 2*v_prime/3 - v)
+        valid = (duv <= max_duv) & (T >= 1000) & (T <= 15000)
+    return np.where(valid, T, np.nan)
+
+
+def _spectral_locus(cmf):
+    # Hue angles around D65 of the spectral locus (1 nm steps, 380-700 nm, increasing) and their wavelengths
+    key = array_hash(cmf)
+    locus = _loci.get(key)
+    if locus is None:
+        wl = np.arange(max(380.0, cmf[0, 0]), min(700.0, cmf[-1, 0]) + 1)
+        lx, ly, _, _ = chromaticity(cmf_on_grid(wl, cmf))
+        angle = np.unwrap(np.arctan2(ly - WHITE_D65[1], lx - WHITE_D65[0]))
+        order = np.argsort(angle)
+        locus = (angle[order], wl[order])
+        _loci.put(key, locus)
+    return locus
+
+
+def dominant_wavelength(x, y, cmf=None):
+    """
+    Dominant wavelength [nm] of each chromaticity relative to D65: where the
+    ray from the white point through (x, y) meets the spectral locus.
+    Purples, whose ray meets the purple line instead, get the complementary
+    wavelength with a negative sign (CIE convention). NaN stays NaN.
+    """
+    cmf = load_cmf() if cmf is None else cmf
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    angle_l, wl = _spectral_locus(cmf)
+    with np.errstate(invalid='ignore'):
+        angle = np.arctan2(y - WHITE_D65[1], x - WHITE_D65[0])
+        # same 2*pi branch as the locus angles
+        angle = angle_l[0] + np.mod(angle - angle_l[0], 2*np.pi)
+        opposite = angle_l[0] + np.mod(angle - np.pi - angle_l[0], 2*np.pi)
+        dominant = np.where(angle <= angle_l[-1], np.interp(angle, angle_l, wl), -np.interp(opposite, angle_l, wl))
+    return np.where(np.isfinite(x) & np.isfinite(y), dominant, np.nan)
+
+
+FIELDS = ('CIE_x', 'CIE_y', 'CIE_u', 'CIE_v', 'CCT', 'dominant_wavelength')
+
+
+def color_coordinates(XYZ, cmf=None, lit=None):
+    """
+    Every quantity in FIELDS from (3, n) tristimulus values, as a dict of (n,)
+    arrays. All of them are NaN for columns that are not real emission: Y <= 0
+    or x, y outside [0, 1] (noise around zero can give any sign to X, Y and Z),
+    and, when lit is given ((n,) bool, e.g. where spectral_features found a
+    peak), the columns that are not lit.
+    """
+    x, y, u, v = chromaticity(XYZ)
+    with np.errstate(invalid='ignore'):
+        valid = (XYZ[1] > 0) & (x >= 0) & (x <= 1) & (y >= 0) & (y <= 1)
+    if lit is not None:
+        valid &= lit
+    x, y, u, v = (np.where(valid, a, np.nan) for a in (x, y, u, v))
+    return {'CIE_x': x, 'CIE_y': y, 'CIE_u': u, 'CIE_v': v, 'CCT': cct(x, y, u, v),
+            'dominant_wavelength': dominant_wavelength(x, y, cmf)}
@@ -0,0 +1,177 @@
+"""
+Binary container for acquired spectra and IV sweeps
+
+A dataset is a single .npz file holding float64 arrays plus a JSON metadata
+record (sample name, date, integration time, sweep settings, ...):
+
+    wavelengths        (nbins,)            nm
+    spectra_voltages   (nspectra,)         V, set voltage of each spectrum
+    intensities        (nbins, nspectra)   counts
+    voltage            (numpoints,)        V, measured bias
+    current            (numpoints,)        mA
+    photocurrent       (numpoints,)        mA
+    reverse_current, reverse_photocurrent  mA, reverse sweep (optional)
+
+Any of the spectra or IV parts may be missing (spectra.py and el.py each
+write one part). The CSV formats read by the post-processor remain available
+through to_spectra_csv / to_iv_csv.
+
+Datasets of results computed from a memory-mapped stack (stack.py) don't
+copy its intensities: metadata['spectra_stack'] records the stack's path
+and content hash, and spectra_matrix() reopens it from there.
+"""
+
+import io
+import json
+import os
+
+import numpy as np
+
+import cache
+import stack
+
+
+SUFFIX = '.npz'
+
+SPECTRA_ARRAYS = ('wavelengths', 'spectra_voltages', 'intensities')
+IV_ARRAYS = ('voltage', 'current', 'photocurrent', 'reverse_current', 'reverse_photocurrent')
+
+
+class Dataset:
+    def __init__(self, arrays=None, metadata=None):
+        self.arrays = dict(arrays or {})
+        self.metadata = dict(metadata or {})
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    @property
+    def has_spectra(self):
+        return 'intensities' in self.arrays or 'spectra_stack' in self.metadata
+
+    @property
+    def has_iv(self):
+        return 'current' in self.arrays
+
+    def spectra_matrix(self):
+        # (nbins, 1+nspectra): wavelength column then one column per voltage, as in the CSV
+        # (a SpectralStack indexed the same way when the dataset refers to a stack)
+        if 'intensities' not in self.arrays and 'spectra_stack' in self.metadata:
+            return stack.open_stack(self.metadata['spectra_stack']['path'])
+        return np.column_stack([self['wavelengths'], self['intensities']])
+
+    def iv_matrix(self):
+        # (numpoints, 3+): V, I (mA), Iphd (mA)[, reverse I, reverse Iphd], as in the CSV
+        names = [name for name in IV_ARRAYS if name in self.arrays]
+        if 'photocurrent' not in self.arrays:
+            raise KeyError('dataset has no photocurrent')
+        return np.column_stack([self[name] for name in names])
+
+    def to_spectra_csv(self, path):
+        header = 'Wavelengths(nm)' + ''.join(f'\t{v}V' for v in self['spectra_voltages'])
+        footer = f"Integration Time (ms) = {self.metadata.get('integration_time_us', '')}"
+        np.savetxt(path, self.spectra_matrix(), fmt='%.18e', delimiter='\t', newline='\n',
+                   header=header, footer=footer)
+
+    def to_iv_csv(self, path):
+        labels = {'voltage': 'Bias(V)', 'current': 'Current(mA)', 'photocurrent': 'Photocurrent(mA)',
+                  'reverse_current': 'ReverseCurrent(mA)', 'reverse_photocurrent': 'ReversePhotocurrent(mA)'}
+        header = '\t'.join(labels[name] for name in IV_ARRAYS if name in self.arrays)
+        np.savetxt(path, self.iv_matrix(), fmt='%.18e', delimiter='\t', newline='\n', header=header)
+
+
+def save_dataset(path, dataset, compress=False):
+    # path may be a file name (.npz is appended if missing) or a binary file object
+    if isinstance(path, (str, os.PathLike)) and not os.fspath(path).endswith(SUFFIX):
+        path = os.fspath(path) + SUFFIX
+    arrays = {name: np.asarray(a, dtype=float) for name, a in dataset.arrays.items()}
+    arrays['metadata'] = np.array(json.dumps(dataset.metadata))
+    (np.savez_compressed if compress else np.savez)(path, **arrays)
+    return path
+
+
+def load_dataset(source):
+    # source: path or file object (e.g. a Streamlit upload)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    if hasattr(source, 'getvalue'):
+        source = io.BytesIO(source.getvalue())
+    with np.load(source, allow_pickle=False) as f:
+        arrays = {name: f[name] for name in f.files if name != 'metadata'}
+        metadata = json.loads(str(f['metadata'])) if 'metadata' in f.files else {}
+    return Dataset(arrays, metadata)
+
+
+def is_dataset(source):
+    # True for .npz paths and for file objects holding a zip archive
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source).endswith(SUFFIX)
+    name = getattr(source, 'name', '')
+    if isinstance(name, str) and name.endswith(SUFFIX):
+        return True
+    if hasattr(source, 'getvalue'):
+        return bytes(source.getvalue()[:4]) == b'PK\x03\x04'
+    if hasattr(source, 'peek'):
+        return source.peek(4)[:4] == b'PK\x03\x04'
+    return False
+
+
+def from_csv(spectra_csv=None, iv_csv=None, metadata=None):
+    # Dataset from the CSV files written by earlier versions of spectra.py / el.py
+    import pipeline
+    arrays = {}
+    if spectra_csv is not None:
+        Spectra = pipeline.read_spectra(spectra_csv)
+        arrays['wavelengths'] = Spectra[:, 0]
+        arrays['intensities'] = Spectra[:, 1:]
+        arrays['spectra_voltages'] = _header_voltages(spectra_csv, Spectra.shape[1]-1)
+    if iv_csv is not None:
+        IV = pipeline.read_iv(iv_csv)
+        for i, name in enumerate(IV_ARRAYS[:IV.shape[1]]):
+            arrays[name] = IV[:, i]
+    return Dataset(arrays, metadata)
+
+
+def from_result(result, metadata=None):
+    # Dataset of a processed sample: spectra, IV and every results column ('results.<name>').
+    # Spectra in a memory-mapped stack are referred to, not loaded and copied.
+    table = result.table
+    Spectra = result.Spectra
+    nspectra = Spectra.shape[1]-1
+    spectra_voltages = np.full(nspectra, np.nan)
+    n = min(nspectra, len(table))
+    spectra_voltages[:n] = table['V'][:n]
+    arrays = {'wavelengths': Spectra[:, 0], 'spectra_voltages': spectra_voltages,
+              'voltage': table['V'], 'current': table['I'], 'photocurrent': table['Iphd']}
+    metadata = dict(metadata or {})
+    if isinstance(Spectra, stack.SpectralStack):
+        metadata['spectra_stack'] = {'path': os.path.abspath(Spectra.path), 'hash': cache.content_hash(Spectra.path)}
+    else:
+        arrays['intensities'] = Spectra[:, 1:]
+    for name in table.names:
+        arrays[f'results.{name}'] = table[name]
+    metadata['units'] = {name: table.unit(name) for name in table.names}
+    metadata['geometry'] = {'D': result.geometry.D, 'A_LED': result.geometry.A_LED, 'A_phd': result.geometry.A_phd}
+    if result.calibration is not None:
+        metadata['calibration'] = result.calibration
+    return Dataset(arrays, metadata)
+
+
+def _header_voltages(spectra_csv, count):
+    # Voltages from header labels like '0.30000000000000004V'
+    if hasattr(spectra_csv, 'seek'):
+        spectra_csv.seek(0)
+        line = spectra_csv.readline()
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+    else:
+        with open(spectra_csv, 'r') as f:
+            line = f.readline()
+    labels = line.lstrip('#').strip().split('\t')[1:]
+    try:
+        return np.array([float(label.rstrip('V')) for label in labels[:count]])
+    except ValueError:
+        return np.full(count, np.nan)
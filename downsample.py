@@ -0,0 +1,57 @@
+"""
+Min/max decimation of dense line plots
+
+Each line is cut into buckets along x and only the lowest and highest point
+of every bucket is kept, in their original order. With about one bucket per
+horizontal pixel the drawn line is indistinguishable from the full one
+(peaks and noise envelopes survive), while the number of vertices is bounded
+by the plot width instead of the spectrometer resolution. All columns of a
+spectra matrix are decimated together.
+"""
+
+import numpy as np
+
+
+# About one bucket per pixel of the 3 inch wide plots at 200 dpi
+BUCKETS = 600
+
+
+def window(x, x_lo=None, x_hi=None):
+    # Slice of the (increasing) x values inside [x_lo, x_hi], widened by one
+    # point on each side so clipped lines still reach the plot edges
+    start = 0 if x_lo is None else max(np.searchsorted(x, x_lo, side='left') - 1, 0)
+    stop = len(x) if x_hi is None else min(np.searchsorted(x, x_hi, side='right') + 1, len(x))
+    return slice(start, stop)
+
+
+def minmax(x, Y, buckets=BUCKETS):
+    """
+    x: (n,) increasing; Y: (n,) or (n, ncols)
+    Returns xs, ys of shape (m, ncols) (or (m,) for a 1-D Y) with m <= 2*buckets.
+    Lines shorter than 2*buckets are returned unchanged.
+    """
+    x = np.asarray(x)
+    Y = np.asarray(Y)
+    vector = Y.ndim == 1
+    if vector:
+        Y = Y[:, None]
+    n, ncols = Y.shape
+    if n <= 2*buckets:
+        xs, ys = np.broadcast_to(x[:, None], Y.shape), Y
+    else:
+        # Equal-sized buckets; the tail is padded by repeating the last point
+        size = -(-n//buckets)
+        pad = size*buckets - n
+        padded = np.concatenate([Y, np.repeat(Y[-1:], pad, axis=0)]) if pad else Y
+        blocks = padded.reshape(buckets, size, ncols)
+        offsets = (np.arange(buckets)*size)[:, None]
+        with np.errstate(invalid='ignore'):
+            lo = np.argmin(blocks, axis=1) + offsets
+            hi = np.argmax(blocks, axis=1) + offsets
+        lo, hi = np.minimum(lo, n-1), np.minimum(hi, n-1)
+        # (2*buckets, ncols) indices, in increasing order within each column
+        idx = np.stack([np.minimum(lo, hi), np.maximum(lo, hi)], axis=1).reshape(2*buckets, ncols)
+        xs, ys = x[idx], np.take_along_axis(Y, idx, axis=0)
+    if vector:
+        return xs[:, 0], ys[:, 0]
+    return xs, ys
@@ -15,13 +15,12 @@ Based off Steve Nichols' Script from ~2010, Univ. of California Santa Barbara
 #IV-Sweep Credits to:
 #https://github.com/demisjohn/Keithley-I-V-Sweep
 
-import pyvisa        # PyVISA module, for GPIB comms
 import numpy as np  # enable NumPy numerical analysis
 import time          # to allow pause between measurements
-import os            # Filesystem manipulation - mkdir, paths etc.
-import matplotlib.pyplot as plt # for python-style plottting, like 'ax1.plot(x,y)'
 from datetime import date
 
+import dataset
+
 import streamlit as st
 st.set_page_config(page_title='EL')
 
@@ -37,6 +36,7 @@ def set_params():
             save_file_input = st.checkbox("Save files", value=True)
         with col2:
             reverse_file_input = st.checkbox("Reverse sweep", value=True)
+        csv_input = st.checkbox("Also export CSV", value=True)
         
         sample_name_input = st.text_input("Sample name", value="QLEDcheng")
         
@@ -64,16 +64,20 @@ def set_params():
         submitted = st.form_submit_button("Run")
         if submitted:
             body(save_file_input, reverse_file_input, sample_name_input, sleep_time_input, current_compliance_input,
-                start_input, stop_input, transition_input, numpoints_input1, numpoints_input2)
+                start_input, stop_input, transition_input, numpoints_input1, numpoints_input2, csv_input)
             if save_file_input:
                 st.success('All files were downloaded!')
 
 def body(save_file_input, reverse_file_input, sample_name_input, sleep_time_input, current_compliance_input, 
-         start_input, stop_input, transition_input, numpoints_input1, numpoints_input2):
+         start_input, stop_input, transition_input, numpoints_input1, numpoints_input2, csv_input=True):
+    #Hardware drivers and plotting are only needed once a sweep is run
+    import pyvisa        # PyVISA module, for GPIB comms
+    import matplotlib.pyplot as plt # for python-style plottting, like 'ax1.plot(x,y)'
     
     #PARAMETERS
     SaveFiles = save_file_input   # Save the plot & data?  Only display if False.
     ReverseSweep = reverse_file_input   # Save the plot & data?  Only display if False.
+    ExportCSV = csv_input   # Write the CSV file next to the .npz dataset?
     Sample_Name = sample_name_input        #sample number
     sleep_time = sleep_time_input #seconds
     CurrentCompliance = current_compliance_input    # compliance (max) current (A)
@@ -257,6 +261,18 @@ def body(save_file_input, reverse_file_input, sample_name_input, sleep_time_inpu
         #IV_photoIV = np.append(IV_photocurrent,Photovoltage,axis=1)
 
     if SaveFiles:
+        #Binary dataset with the sweep(s) and the acquisition settings
+        arrays = {'voltage': Voltage[:,0], 'current': Current[:,0], 'photocurrent': Photocurrent[:,0]}
+        if ReverseSweep:
+            arrays['reverse_current'] = ReverseCurrent[:,0]
+            arrays['reverse_photocurrent'] = ReversePhotocurrent[:,0]
+        data = dataset.Dataset(arrays, {'sample_name': Sample_Name, 'date': date_string, 'start_V': start,
+                                        'transition_V': transition, 'stop_V': stop, 'numpoints': numpoints,
+                                        'sleep_time_s': sleep_time, 'current_compliance_A': CurrentCompliance,
+                                        'pixel_area_cm2': pixel_area})
+        dataset.save_dataset(f'IV+Spectra/{date_string}{Sample_Name}_{start}V-{stop}V_IV+photocurrent.npz', data)
+
+    if SaveFiles and ExportCSV:
         if ReverseSweep:
             np.savetxt(f'IV+Spectra/{date_string}{Sample_Name}_{start}V-{stop}V_IV+photocurrent.csv', IV_plusReverse, 
                    fmt='%.18e', delimiter='\t', newline='\n', header='Bias(V)\tCurrent(mA)\tPhotocurrent(mA)\tReverseCurrent(mA)\tReversePhotocurrent(mA)')
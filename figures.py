@@ -0,0 +1,507 @@
+"""
+Figures of the post-processing app, without Streamlit
+
+The graphN builders draw a pipeline.Result into a new matplotlib figure.
+Rendered figures are cached as PNG (or SVG) bytes in a bounded LRU keyed on
+whatever identifies the picture: the result, the graph and its scale/limit
+settings. The cache lives in this module so it survives Streamlit reruns; a
+rerun caused by an unrelated widget only looks the bytes up again.
+
+export_figures() renders and writes figures in a pool of worker processes
+(Agg backend) without blocking the caller, and zip_bytes() packs files into
+an in-memory ZIP for download.
+"""
+
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+import numpy as np
+
+import downsample
+import instrument
+import pipeline
+import stack
+import sweep
+import uncertainty
+from cache import LRUCache
+
+
+FIGURE_ENTRIES = 128
+FIGURE_BYTES = 64*2**20
+
+# Same settings st.pyplot uses
+DPI = 200
+
+EXPORT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+_rendered = LRUCache(FIGURE_ENTRIES, FIGURE_BYTES, sizeof=len)
+_exported = LRUCache(4*FIGURE_ENTRIES)
+_pool = None
+
+
+@instrument.timed('figures.render')
+def render(fig, format='png', dpi=DPI):
+    # Bytes of the figure with a tight bounding box; the figure is closed afterwards
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=format, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+def cached_render(key, build, format='png', dpi=DPI):
+    """
+    Rendered bytes of build() (a function returning a new figure), drawn only
+    if nothing is cached under (key, format, dpi). key must be hashable and
+    cover everything the figure depends on. A key of None disables caching.
+    """
+    if key is None:
+        return render(build(), format, dpi)
+    key = (key, format, dpi)
+    data = _rendered.get(key)
+    if data is None:
+        data = render(build(), format, dpi)
+        _rendered.put(key, data)
+    return data
+
+
+def clear():
+    _rendered.clear()
+
+
+#https://matplotlib.org/3.5.0/tutorials/colors/colormaps.html
+#https://matplotlib.org/3.5.0/tutorials/colors/colormap-manipulation.html
+colors = plt.get_cmap('PuBu', 8)
+
+
+def plot_style():
+    plt.rc('font', family='Arial')
+    plt.rcParams['axes.linewidth'] = 2
+    plt.rc('xtick', labelsize='small')
+    plt.rc('ytick', labelsize='small')
+    plt.rcParams['font.size'] = 12
+
+
+# Blocks of a stack read at a time for plotting (decimation holds a few copies of one block)
+PLOT_CHUNK_BYTES = 16*2**20
+
+
+def spectra_lines(spectra, columns, decimate=False, x_lo=0.0, x_hi=0.0):
+    # Wavelengths and the given columns of a spectra matrix as (m, len(columns)) arrays,
+    # clipped to the x window when one is set and min/max decimated if asked
+    wavelengths = spectra[:, 0]
+    rows = slice(None)
+    if x_lo < 0.0 or x_hi > 0.0:
+        rows = downsample.window(wavelengths, x_lo, x_hi)
+    x = wavelengths[rows]
+    if isinstance(spectra, (stack.SpectralStack, stack.NormalizedStack)):
+        return _stack_lines(spectra, np.asarray(columns, dtype=int), rows, x, decimate)
+    Y = np.column_stack([spectra[rows, k] for k in columns]) if len(columns) else np.empty((len(x), 0))
+    if decimate:
+        return downsample.minmax(x, Y)
+    return np.broadcast_to(x[:, None], Y.shape), Y
+
+
+def _stack_lines(spectra, columns, rows, x, decimate):
+    # spectra_lines of a memory-mapped stack: one bounded block of spectra at a time is read and
+    # (if asked) decimated straight into its columns of the output, so only the output grows
+    # with the number of spectra
+    m = 2*downsample.BUCKETS if decimate and len(x) > 2*downsample.BUCKETS else len(x)
+    xs, ys = np.empty((m, len(columns))), np.empty((m, len(columns)))
+    for start, block in spectra.iter_chunks(PLOT_CHUNK_BYTES):
+        # Positions in columns (matrix columns, 1-based spectra) of the spectra in this block
+        wanted = np.flatnonzero((columns > start) & (columns <= start+block.shape[1]))
+        if not len(wanted):
+            continue
+        Y = block[rows][:, columns[wanted]-1-start]
+        if decimate:
+            xs[:, wanted], ys[:, wanted] = downsample.minmax(x, Y)
+        else:
+            xs[:, wanted], ys[:, wanted] = x[:, None], Y
+    return xs, ys
+
+
+def _wavelength_limits(ax, x_lo, x_hi):
+    if x_lo < 0.0 or x_hi > 0.0:
+        ax.set_xlim(x_lo,x_hi)
+
+
+# Figure builders: each returns a new figure for a pipeline.Result. Options
+# (scales, axis limits) come after the sample name, in the order of the
+# app's graphN functions.
+
+def graph2(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.table['V'],result.table['Iphd'],linewidth=2)
+
+    ax.set_xlabel('Bias Voltage(V)')
+    ax.set_ylabel('Photocurrent(mA)')
+    ax.set_title(f'EL Characteristics of\n {sample_name}')
+    return fig
+
+
+def graph3(result, sample_name, decimate=False, x_lo=0.0, x_hi=0.0):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    xs, ys = spectra_lines(result.Spectra, np.arange(result.numpoints)+1, decimate, x_lo, x_hi)
+    for k in range(result.numpoints):
+        ax.plot(xs[:,k],ys[:,k],color = colors(k/result.numpoints), 
+                 label=f'{"{:.1f}".format(result.table["V"][k])}V', linewidth = 0.5)
+    _wavelength_limits(ax, x_lo, x_hi)
+    
+    ax.set_xlabel('Wavelength(nm)')
+    ax.set_ylabel('Counts')
+    ax.set_title(f'Electroluminescence Spectra at Each\n Bias Voltage of {sample_name}')
+    
+    ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0, frameon=False, fontsize=10, ncol=3)
+    return fig
+
+
+def graph4(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.photodiode_data[:,0],result.photodiode_data[:,3],linewidth=2)
+
+    ax.set_xlabel('Wavelength(nm)')
+    ax.set_ylabel('Responsivity (A/W)')
+    ax.set_title('Responsivity Function of Photodiode E')
+    return fig
+
+
+def graph5(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.photodiode_data[:,0],result.photodiode_data[:,2],linewidth=2)
+
+    ax.set_xlabel(r'Wavelength($\lambda$)')
+    ax.set_ylabel('EQE(%)')
+    ax.set_title('Wavelength dependent EQE of device\n measured by Photodiode E?')
+    return fig
+
+
+def graph7(result, sample_name, decimate=False, x_lo=0.0, x_hi=0.0):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    xs, ys = spectra_lines(result.normalized_spectra, np.arange(result.numpoints)+1, decimate, x_lo, x_hi)
+    for k in range(result.numpoints):
+        ax.plot(xs[:,k],ys[:,k],color = colors(k/result.numpoints), 
+                 label=f'{result.table["V"][k]}V', linewidth = 1)
+    _wavelength_limits(ax, x_lo, x_hi)
+
+    ax.set_xlabel('Wavelength(nm)')
+    ax.set_ylabel('Counts')
+    ax.set_title(f'Normalized Electroluminescence Spectra at Each\n Bias Voltage of {sample_name}')
+    ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0, frameon=False, fontsize=10, ncol=3)
+    return fig
+
+
+def graph9(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.table['V'],result.table['photon_flux'],linewidth=2)
+
+    ax.set_xlabel('Bias Voltage(V)')
+    ax.set_ylabel('Photon flux ($photon.s^{-1}.sr^{-1}$)')
+    ax.set_title(f'Incident Photon Flux on Photodiode\nfrom {sample_name}')
+    return fig
+
+
+def graph10(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.table['V'],result.table['radiance'],linewidth=2)
+
+    ax.set_xlabel('Bias Voltage(V)')
+    ax.set_ylabel('Radiance ($W.sr^{-1}.m^{-2}$)')
+    ax.set_title(f'LED Radiance vs. Voltage \nfor {sample_name}')
+    return fig
+
+
+def graph12(result, sample_name, EQE, x_lo, x_hi, y_lo, y_hi, uncertainties=None):
+    # uncertainties: uncertainty.Uncertainties, to shade the Monte Carlo confidence band
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    line, = ax.plot(result.table['J']/1000,result.table['EQE'],linewidth=2)
+    if uncertainties is not None:
+        bands = uncertainty.cached_propagate(result, uncertainties)
+        ax.fill_between(result.table['J']/1000, bands.lower['EQE'], bands.upper['EQE'],
+                        color=line.get_color(), alpha=0.3, linewidth=0)
+
+    ax.set_xlabel('Current Density (A/$cm^{-2}$)')
+    ax.set_ylabel('EQE(%)')
+    ax.set_title(f'LED EQE vs. Current Density \nfor {sample_name}')
+    
+    if x_lo < 0.0 or x_hi > 0.0:
+        ax.set_xlim(x_lo,x_hi)
+    
+    if y_lo < 0.0 or y_hi > 0.0:
+        ax.set_ylim(y_lo,y_hi)
+ 
+    ax.set_yscale(EQE)
+    ax.set_xscale('log') #as opposed to 'linear'
+    return fig
+
+
+def graph15(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.phototopic[:,0],result.phototopic[:,1],linewidth=2)
+
+    ax.set_xlabel('Wavelength(nm)')
+    ax.set_ylabel('Phototopic factor')
+    ax.set_title('Phototopic response of the human eye to light')
+    return fig
+
+
+def graph17(result, sample_name):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.table['J']/1000,result.table['luminance'],linewidth=2)
+
+    ax.set_xlabel('Current Density (A/$cm^{-2}$)')
+    ax.set_ylabel('Luminance (cd/$m^{-2}$)')
+    ax.set_title(f'Luminance vs. Current Density \nfor {sample_name}')
+    return fig
+
+
+def graph22(result, sample_name, x_lo, x_hi, y_lo, y_hi):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(result.table['J']/1000,result.table['luminous_efficacy'],linewidth=2)
+
+    ax.set_xlabel('Current Density (A/$cm^{-2}$)')
+    ax.set_ylabel('Luminous Efficacy (lm/W)')
+    ax.set_title(f'Luminous Efficacy vs. Current Density \nfor {sample_name}')
+    
+    if x_lo < 0.0 or x_hi > 0.0:
+        ax.set_xlim(x_lo,x_hi)
+    
+    if y_lo < 0.0 or y_hi > 0.0:
+        ax.set_ylim(y_lo,y_hi)
+
+    ax.set_xscale('log') #as opposed to 'linear'
+    return fig
+
+
+def graph26(result, sample_name, current, luminance, start_voltage, x_lo, x_hi, cd_y_lo, cd_y_hi, l_y_lo, l_y_hi,
+            uncertainties=None):
+    #JVL curve; uncertainties shades the Monte Carlo confidence band of the luminance
+    V = result.table['V']
+    
+    # default x limits: the autoscaled range of the full sweep (data range plus the axes
+    # margin), computed directly instead of drawing the full figure first
+    margin = plt.rcParams['axes.xmargin']*(np.nanmax(V) - np.nanmin(V))
+    left, right = np.nanmin(V) - margin, np.nanmax(V) + margin
+    
+    # find the point to start plotting
+    idx = 0
+    for x in range(0, result.numpoints):
+        if V[x] >= start_voltage:
+            break
+            
+        idx +=1
+    
+    fig, ax1 = plt.subplots(figsize=(4, 4))
+    ax2 = ax1.twinx()
+    line1, = ax1.plot(V[idx:],result.table['J'][idx:],linewidth=2, color ='green', label = 'Current Density')
+    line2, = ax2.plot(V[idx:],result.table['luminance'][idx:],linewidth=2, label = 'Luminance')
+    if uncertainties is not None:
+        bands = uncertainty.cached_propagate(result, uncertainties)
+        ax2.fill_between(V[idx:], bands.lower['luminance'][idx:], bands.upper['luminance'][idx:],
+                         color=line2.get_color(), alpha=0.3, linewidth=0)
+    
+    ax1.legend(handles=[line1, line2], fontsize = 10)
+
+    ax1.set_xlabel(r'Voltage (V)', labelpad=10)
+    ax1.set_ylabel('Current density (mA$.cm^{-2}$)', labelpad=10)
+    ax1.set_title(f'JVL curve \nfor {sample_name}', fontsize = 14)
+    ax2.set_ylabel('Luminance (cd.$m^{-2}$)')
+    
+    # default x range
+    ax1.set_xlim(left, right)
+    
+    if x_lo < 0.0 or x_hi > 0.0:
+        ax1.set_xlim(x_lo,x_hi)
+    
+    if cd_y_lo < 0.0 or cd_y_hi > 0.0:
+        ax1.set_ylim(cd_y_lo,cd_y_hi)
+        
+    if l_y_lo < 0.0 or l_y_hi > 0.0:
+        ax2.set_ylim(l_y_lo,l_y_hi)
+    
+    ax1.set_yscale(current)
+    ax2.set_yscale(luminance)
+    return fig
+
+
+def graph30(result, sample_name, increment, decimate=False, x_lo=0.0, x_hi=0.0):
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+    selected_spectra = np.arange(0,result.numpoints,increment)
+    xs, ys = spectra_lines(result.Spectra, selected_spectra+1, decimate, x_lo, x_hi)
+    for j, k in enumerate(selected_spectra):
+        ax.plot(xs[:,j],ys[:,j],color = colors(k/result.numpoints), 
+                 label=f'{result.table["V"][k]}V', linewidth = 1)
+    _wavelength_limits(ax, x_lo, x_hi)
+    ax.set_xlabel('Wavelength(nm)')
+    ax.set_ylabel('Counts')
+    ax.set_title(f'Electroluminescence Spectra at Each\n Bias Voltage of {sample_name}')
+    ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0, frameon=False, fontsize=10, ncol=3)
+    return fig
+
+
+def graph31(result, sample_name):
+    #CIE 1931 chromaticity of the emission at each voltage, from turn-on upwards
+    #(below it the spectra are mostly noise)
+    V = result.table['V']
+    lit = result.table['luminance'] >= pipeline.TURN_ON_LUMINANCE
+    if not np.any(lit):
+        lit = np.isfinite(result.table['CIE_x'])
+    
+    fig = plt.figure(figsize=(3, 3))
+    ax = fig.add_axes([0, 0, 1, 1])
+
+    ax.plot(V[lit],result.table['CIE_x'][lit],linewidth=2, marker='o', markersize=3, label='x')
+    ax.plot(V[lit],result.table['CIE_y'][lit],linewidth=2, marker='o', markersize=3, label='y')
+
+    ax.set_xlabel('Bias Voltage(V)')
+    ax.set_ylabel('CIE 1931 chromaticity')
+    ax.set_title(f'Chromaticity Shift vs. Voltage \nfor {sample_name}')
+    ax.legend(frameon=False, fontsize=10)
+    return fig
+
+
+def graph32(result, sample_name):
+    #Peak shift and broadening of the emission with bias (NaN below turn-on is not drawn)
+    V = result.table['V']
+    
+    fig, ax1 = plt.subplots(figsize=(4, 4))
+    ax2 = ax1.twinx()
+    line1, = ax1.plot(V,result.table['peak_wavelength'],linewidth=2, marker='o', markersize=3,
+                      label = 'Peak wavelength')
+    line2, = ax2.plot(V,result.table['FWHM'],linewidth=2, marker='o', markersize=3, color ='green',
+                      label = 'FWHM')
+    
+    ax1.legend(handles=[line1, line2], fontsize = 10)
+
+    ax1.set_xlabel('Bias Voltage(V)')
+    ax1.set_ylabel('Peak wavelength (nm)')
+    ax2.set_ylabel('FWHM (nm)')
+    ax1.set_title(f'Peak Wavelength and FWHM vs. Voltage \nfor {sample_name}', fontsize = 14)
+    return fig
+
+
+SWEEP_LABELS = {'EQE': 'EQE (%)', 'radiance': 'Radiance (W.$sr^{-1}.m^{-2}$)',
+                'luminance': 'Luminance (cd.$m^{-2}$)'}
+
+
+def graph33(result, sample_name, D_range, A_LED_range, A_phd_range, metric, voltage):
+    #Geometry sweep: one D x A_phd heatmap per A_LED value (EQE doesn't depend on A_LED, so it
+    #gets a single panel). Ranges are (min, max, steps); voltage None shows the peak above turn-on.
+    grid = sweep.geometry_sweep(result, sweep.grid(*D_range), sweep.grid(*A_LED_range), sweep.grid(*A_phd_range))
+    values = grid.reduce(metric, voltage)
+    panels = 1 if metric == 'EQE' else len(grid.A_LED)
+    columns = min(panels, 3)
+    rows = -(-panels//columns)
+    fig, axes = plt.subplots(rows, columns, figsize=(3*columns+1, 3*rows), squeeze=False, sharex=True,
+                             sharey=True, constrained_layout=True)
+    # Log colour scale: the values span decades over a wide sweep
+    finite = values[np.isfinite(values) & (values > 0)]
+    norm = LogNorm(finite.min(), finite.max()) if len(finite) else None
+    for i, ax in enumerate(axes.flat):
+        if i >= panels:
+            ax.set_visible(False)
+            continue
+        image = ax.pcolormesh(grid.A_phd, grid.D, values[:, i, :], shading='nearest', norm=norm,
+                              cmap='viridis')
+        if metric != 'EQE':
+            ax.set_title(f'$A_{{LED}}$ = {grid.A_LED[i]:g} mm$^2$', fontsize=10)
+    for ax in axes[-1]:
+        ax.set_xlabel('$A_{phd}$ ($mm^2$)')
+    for ax in axes[:, 0]:
+        ax.set_ylabel('D (mm)')
+    fig.colorbar(image, ax=axes, shrink=0.8, label=SWEEP_LABELS[metric])
+    at = 'peak' if voltage is None else f'{voltage:g} V'
+    fig.suptitle(f'{metric} ({at}) over the detector geometry \nfor {sample_name}', fontsize=12)
+    return fig
+
+
+GRAPHS = {
+    'graph2': graph2, 'graph3': graph3, 'graph4': graph4, 'graph5': graph5, 'graph7': graph7,
+    'graph9': graph9, 'graph10': graph10, 'graph12': graph12, 'graph15': graph15, 'graph17': graph17,
+    'graph22': graph22, 'graph26': graph26, 'graph30': graph30, 'graph31': graph31,
+    'graph32': graph32, 'graph33': graph33,
+}
+
+
+def draw(graph_id, result, sample_name, params=()):
+    with instrument.stage(f'figures.{graph_id}'):
+        return GRAPHS[graph_id](result, sample_name, *params)
+
+
+def _export_pool():
+    # Started on first export and reused. Spawned workers don't inherit the
+    # Streamlit server's threads or GUI backend.
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(EXPORT_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_export_worker)
+    return _pool
+
+
+def _init_export_worker():
+    plt.switch_backend('Agg')
+    plot_style()
+
+
+def _export_one(graph_id, result, sample_name, params, path, format, dpi):
+    data = render(draw(graph_id, result, sample_name, params), format, dpi)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def export_figures(result, sample_name, jobs, format='png', dpi=DPI):
+    """
+    Render and write figures in the export pool. jobs are (graph_id, params,
+    path) tuples. Returns the futures (one per file actually submitted)
+    without waiting for them; files already written for the same result and
+    settings are skipped.
+    """
+    pool = _export_pool()
+    futures = []
+    for graph_id, params, path in jobs:
+        params = tuple(params)
+        key = (result.key, sample_name, graph_id, params, os.path.abspath(path), format, dpi)
+        if result.key is not None and key in _exported and os.path.exists(path):
+            continue
+        # A memory-mapped stack is pickled as its path (stack.SpectralStack), not its spectra
+        futures.append(pool.submit(_export_one, graph_id, result, sample_name, params, path, format, dpi))
+        _exported.put(key, True)
+    return futures
+
+
+def zip_bytes(files):
+    # In-memory ZIP of {name: bytes}; images are stored as they are, other files deflated
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files.items():
+            stored = name.endswith(('.png', '.jpg'))
+            archive.writestr(name, data, zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
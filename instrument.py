@@ -0,0 +1,114 @@
+"""
+Lightweight per-stage instrumentation
+
+Code blocks are wrapped in stage(name) (or decorated with timed(name)) and
+every run adds to that name's call count, total and maximum wall time. While
+memory tracing is on (trace_memory(True), uses tracemalloc and slows Python
+down noticeably) the rise of the traced peak above the memory in use when
+the block started is recorded too: exact when the block sets a new
+high-water mark, an upper bound otherwise. The process-wide tracemalloc peak
+is only read, never reset, so nested stages, concurrent sessions and any
+other tracemalloc user are left undisturbed. Statistics are kept per
+process until reset(); snapshot() returns them as plain rows for tables and
+JSON, and merge() combines the rows of several processes.
+"""
+
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+_lock = threading.Lock()
+_stats = {}
+
+
+class _Stat:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.peak = None
+
+
+def trace_memory(enabled=True):
+    # Start or stop recording peak allocations (tracemalloc)
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+@contextmanager
+def stage(name):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        allocated = None
+        if tracing and tracemalloc.is_tracing():
+            allocated = max(0, tracemalloc.get_traced_memory()[1] - current)
+        with _lock:
+            stat = _stats.setdefault(name, _Stat())
+            stat.calls += 1
+            stat.total += elapsed
+            stat.max = max(stat.max, elapsed)
+            if allocated is not None:
+                stat.peak = allocated if stat.peak is None else max(stat.peak, allocated)
+
+
+def timed(name):
+    # Decorator form of stage()
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    # One row per stage: name, calls, total_s, mean_s, max_s, peak_bytes (None unless traced)
+    with _lock:
+        return [{'name': name, 'calls': stat.calls, 'total_s': stat.total, 'mean_s': stat.total/stat.calls,
+                 'max_s': stat.max, 'peak_bytes': stat.peak} for name, stat in sorted(_stats.items())]
+
+
+def merge(*snapshots):
+    # Combine snapshot() rows of several runs or processes
+    merged = {}
+    for rows in snapshots:
+        for row in rows:
+            m = merged.setdefault(row['name'], {'name': row['name'], 'calls': 0, 'total_s': 0.0, 'max_s': 0.0,
+                                                'peak_bytes': None})
+            m['calls'] += row['calls']
+            m['total_s'] += row['total_s']
+            m['max_s'] = max(m['max_s'], row['max_s'])
+            if row['peak_bytes'] is not None:
+                m['peak_bytes'] = max(m['peak_bytes'] or 0, row['peak_bytes'])
+    rows = []
+    for name in sorted(merged):
+        m = merged[name]
+        m['mean_s'] = m['total_s']/m['calls'] if m['calls'] else 0.0
+        rows.append({key: m[key] for key in ('name', 'calls', 'total_s', 'mean_s', 'max_s', 'peak_bytes')})
+    return rows
+
+
+def to_json(path, rows=None, **extra):
+    # Write rows (default: the current snapshot) plus any extra entries as JSON
+    report = dict(extra, stages=snapshot() if rows is None else rows)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+        f.write('\n')
@@ -0,0 +1,85 @@
+"""
+Reusable linear-interpolation index between two wavelength grids
+
+The bracketing indices and weights for a (source grid, target grid) pair are
+computed once and cached in memory and on disk, so resampling a calibration
+curve onto the usual 2048-point spectrometer grid is a gather and a
+multiply-add after the first run. Results are the same as np.interp
+(values outside the source range are clamped to the end values).
+"""
+
+import os
+
+import numpy as np
+
+from cache import LRUCache, array_hash, cache_dir, prune_dir
+
+
+MEMORY_ENTRIES = 16
+DISK_ENTRIES = 64
+
+_memory = LRUCache(MEMORY_ENTRIES)
+
+
+class InterpIndex:
+    """
+    y_dst = y_src[lo]*(1-weight) + y_src[lo+1]*weight for every target point
+    """
+
+    def __init__(self, lo, weight):
+        self.lo = lo
+        self.weight = weight
+
+    @classmethod
+    def build(cls, x_src, x_dst):
+        x_src = np.asarray(x_src, dtype=float)
+        x_dst = np.asarray(x_dst, dtype=float)
+        lo = np.searchsorted(x_src, x_dst, side='right') - 1
+        lo = np.clip(lo, 0, len(x_src)-2)
+        weight = (x_dst - x_src[lo])/(x_src[lo+1] - x_src[lo])
+        weight = np.clip(weight, 0.0, 1.0)
+        return cls(lo.astype(np.int64), weight)
+
+    def apply(self, y_src):
+        # y_src may be 1-D or have the source grid along its first axis
+        y_src = np.asarray(y_src, dtype=float)
+        w = self.weight.reshape((-1,) + (1,)*(y_src.ndim-1))
+        return y_src[self.lo]*(1-w) + y_src[self.lo+1]*w
+
+
+def get_index(x_src, x_dst, persist=True):
+    # Cached InterpIndex for the pair of grids (memory first, then disk)
+    key = array_hash(np.asarray(x_src, dtype=float), np.asarray(x_dst, dtype=float))
+    index = _memory.get(key)
+    if index is not None:
+        return index
+
+    path = os.path.join(cache_dir('interp'), key+'.npz') if persist else None
+    if path is not None and os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                index = InterpIndex(f['lo'], f['weight'])
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            index = None
+
+    if index is None:
+        index = InterpIndex.build(x_src, x_dst)
+        if path is not None:
+            # A read-only or full disk only costs the persistent copy
+            try:
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as fh:
+                    np.savez(fh, lo=index.lo, weight=index.weight)
+                os.replace(tmp, path)
+                prune_dir(os.path.dirname(path), DISK_ENTRIES, suffix='.npz')
+            except OSError:
+                pass
+
+    _memory.put(key, index)
+    return index
+
+
+def resample(x_src, y_src, x_dst):
+    # np.interp(x_dst, x_src, y_src) through the cached index
+    return get_index(x_src, x_dst).apply(y_src)
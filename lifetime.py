@@ -0,0 +1,305 @@
+"""
+Streaming luminance-decay (lifetime) processing
+
+Reads the tab-separated EL-decay logs (*_EL_time_IV_*.csv: time (s),
+voltage (V), current (mA), photocurrent (mA)) in chunks, including files that
+are still being written, converts the photocurrent to luminance with the
+C and K factors of a processed IV+Spectra sweep, and keeps online estimates:
+a rolling average of the luminance and the times at which it first falls to
+95%, 80% and 50% of its initial value (T95, T80, T50), each average taken
+at the centre of its window. Until a level is
+reached, a projection from an exponential fit of the decay so far is given.
+Memory use is bounded by the chunk size, whatever the length of the run.
+
+    python lifetime.py 2024-04-04..._EL_time_IV_1mA.csv --spectra S.csv --iv IV.csv --follow
+"""
+
+import argparse
+import io
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+import instrument
+import pipeline
+from spectral_engine import e
+
+
+TIME_COLUMN = 0
+PHOTOCURRENT_COLUMN = 3   # mA
+
+LEVELS = (0.95, 0.8, 0.5)
+
+CHUNK_BYTES = 4*2**20
+
+
+def luminance_factor(result, index=None):
+    """
+    Luminance [cd.m-2] per mA of photocurrent, from the C and K of one
+    spectrum of a processed sweep and its geometry (the same conversion as
+    the results table). index defaults to the voltage of maximum luminance,
+    the spectrum closest to the usual constant-current operating point.
+    """
+    if index is None:
+        index = int(np.nanargmax(result.table['luminance']))
+    geometry = result.geometry
+    return result.Ks[index]/(1000*geometry.Omega_phd*result.Cs[index]*e*geometry.A_LED*1e-6)
+
+
+class LogTail:
+    """
+    Incremental reader of a growing tab-separated log. read() returns the
+    complete lines added since the last call as an (n, ncolumns) array; a
+    line still being written is left for the next call.
+    """
+
+    def __init__(self, path, chunk_bytes=CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.offset = 0
+
+    @instrument.timed('lifetime.read')
+    def read(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(self.chunk_bytes)
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return None
+        self.offset += end
+        with np.errstate(all='ignore'):
+            rows = np.loadtxt(io.StringIO(data[:end].decode('utf-8', 'replace')), delimiter='\t',
+                              comments='#', ndmin=2)
+        return rows if rows.size else None
+
+    def chunks(self):
+        # Everything available now, chunk by chunk
+        while True:
+            rows = self.read()
+            if rows is None:
+                return
+            yield rows
+
+
+class DecayTracker:
+    """
+    Online T95/T80/T50 of a luminance decay.
+
+    factor: cd.m-2 per mA of photocurrent (see luminance_factor)
+    window: number of samples in the rolling average; each average is placed
+        at the mean time of its samples, so crossings carry no half-window lag
+    baseline: number of initial samples for the initial luminance L0, the
+        least-squares line through them evaluated at the first sample
+    """
+
+    def __init__(self, factor, window=10, baseline=5, levels=LEVELS):
+        self.factor = factor
+        self.window = window
+        self.baseline = baseline
+        self.levels = tuple(levels)
+        self.L0 = None
+        self.crossed = {level: None for level in self.levels}
+        self.samples = 0
+        self.last_time = math.nan
+        self.last_rolling = math.nan
+        self._head = []             # samples collected for L0
+        self._tail = np.empty(0)    # last window-1 luminances, for the rolling average
+        self._tail_t = np.empty(0)  # and their times, for the centre of each average
+        self._previous = None       # (centre time, rolling) of the last sample, for interpolating crossings
+        self._fit = np.zeros(5)     # n, sum t, sum t^2, sum y, sum t*y with y = ln(rolling/L0), t the centre time
+
+    @instrument.timed('lifetime.update')
+    def update(self, t, photocurrent):
+        """
+        Add samples (time in s, photocurrent in mA). Returns the luminance and
+        its rolling average for these samples.
+        """
+        t = np.asarray(t, dtype=float)
+        luminance = np.asarray(photocurrent, dtype=float)*self.factor
+        if len(t) == 0:
+            return luminance, luminance
+
+        joined = np.concatenate([self._tail, luminance])
+        sums = np.cumsum(np.concatenate([[0.0], joined]))
+        counts = np.minimum(np.arange(len(self._tail)+1, len(joined)+1), self.window)
+        ends = np.arange(len(self._tail)+1, len(joined)+1)
+        rolling = (sums[ends] - sums[ends-counts])/counts
+        # A trailing average describes the luminance at the mean time of its samples, not at the last one
+        joined_t = np.concatenate([self._tail_t, t])
+        sums_t = np.cumsum(np.concatenate([[0.0], joined_t]))
+        centres = (sums_t[ends] - sums_t[ends-counts])/counts
+        self._tail = joined[-(self.window-1):] if self.window > 1 else np.empty(0)
+        self._tail_t = joined_t[-(self.window-1):] if self.window > 1 else np.empty(0)
+
+        if self.L0 is None:
+            missing = self.baseline - len(self._head)
+            self._head.extend(zip(t[:missing], luminance[:missing]))
+            if len(self._head) >= self.baseline:
+                self.L0 = self._initial_luminance()
+        if self.L0 is not None and self.L0 > 0:
+            self._track(centres, rolling)
+
+        self.samples += len(t)
+        self.last_time = float(t[-1])
+        self.last_rolling = float(rolling[-1])
+        self._previous = (float(centres[-1]), float(rolling[-1]))
+        return luminance, rolling
+
+    def _initial_luminance(self):
+        # Line through the baseline samples at the first sample time: their plain mean sits at their
+        # mean time, already partly decayed, and would move every crossing later
+        th, lh = np.array(self._head, dtype=float).T
+        if len(th) < 2 or np.ptp(th) == 0:
+            return float(np.mean(lh))
+        slope, intercept = np.polyfit(th - th[0], lh, 1)
+        return float(intercept)
+
+    def _track(self, t, rolling):
+        relative = rolling/self.L0
+        for level in self.levels:
+            if self.crossed[level] is not None:
+                continue
+            below = np.nonzero(relative <= level)[0]
+            if not len(below):
+                continue
+            i = below[0]
+            if i > 0:
+                t0, r0 = t[i-1], relative[i-1]
+            elif self._previous is not None:
+                t0, r0 = self._previous[0], self._previous[1]/self.L0
+            else:
+                t0, r0 = t[i], relative[i]
+            frac = 0.0 if r0 == relative[i] else (r0 - level)/(r0 - relative[i])
+            self.crossed[level] = float(t0 + frac*(t[i] - t0))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.log(relative)
+        ok = np.isfinite(y)
+        tt, y = t[ok], y[ok]
+        self._fit += (len(tt), tt.sum(), (tt*tt).sum(), y.sum(), (tt*y).sum())
+
+    def projected(self, level):
+        # Time at which the fitted exponential decay reaches level (NaN if not decaying)
+        n, st, stt, sy, sty = self._fit
+        denominator = n*stt - st*st
+        if n < 2 or denominator <= 0:
+            return math.nan
+        slope = (n*sty - st*sy)/denominator
+        intercept = (sy - slope*st)/n
+        if slope >= 0:
+            return math.nan
+        return (math.log(level) - intercept)/slope
+
+    def estimates(self):
+        # {'T95': (seconds, measured?), ...}: measured crossing, else the projection
+        out = {}
+        for level in self.levels:
+            name = f'T{round(level*100)}'
+            if self.crossed[level] is not None:
+                out[name] = (self.crossed[level], True)
+            else:
+                out[name] = (self.projected(level), False)
+        return out
+
+    def summary(self):
+        row = {'samples': self.samples, 'time(s)': self.last_time, 'L0(cd.m-2)': self.L0,
+               'rolling_luminance(cd.m-2)': self.last_rolling}
+        for name, (value, measured) in self.estimates().items():
+            row[f'{name}(s)'] = value
+            row[f'{name}_measured'] = measured
+        return row
+
+
+def process(path, factor, out_path=None, follow=False, interval=5.0, idle_timeout=None, window=10,
+            baseline=5, callback=None):
+    """
+    Run a DecayTracker over the log at path. With follow, keeps polling the
+    file every interval seconds for new lines until idle_timeout seconds pass
+    without any (forever if None). Writes time, photocurrent, luminance and
+    rolling luminance to out_path as it goes; callback(tracker) is called
+    after every chunk. Returns the tracker.
+    """
+    tracker = DecayTracker(factor, window, baseline)
+    tail = LogTail(path)
+    out = None
+    if out_path is not None:
+        out = open(out_path, 'w')
+        out.write('# time[s]\tPhotocurrent[mA]\tLuminance[cd/m^2]\tRollingLuminance[cd/m^2]\n')
+    try:
+        idle_since = time.monotonic()
+        while True:
+            got = False
+            for rows in tail.chunks():
+                got = True
+                t, photocurrent = rows[:, TIME_COLUMN], rows[:, PHOTOCURRENT_COLUMN]
+                luminance, rolling = tracker.update(t, photocurrent)
+                if out is not None:
+                    np.savetxt(out, np.column_stack([t, photocurrent, luminance, rolling]), fmt='%.8e',
+                               delimiter='\t')
+                    out.flush()
+                if callback is not None:
+                    callback(tracker)
+            if not follow:
+                break
+            if got:
+                idle_since = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                break
+            time.sleep(interval)
+    finally:
+        if out is not None:
+            out.close()
+    return tracker
+
+
+def _report(tracker):
+    parts = [f"t={tracker.last_time:.0f}s", f"L={tracker.last_rolling:.4g}cd/m2"]
+    for name, (value, measured) in tracker.estimates().items():
+        parts.append(f"{name}={value:.4g}s" + ('' if measured else ' (projected)'))
+    print('  '.join(parts), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Luminance decay (T95/T80/T50) from an EL-decay log.')
+    parser.add_argument('log', help='tab-separated log: time (s), voltage, current (mA), photocurrent (mA)')
+    parser.add_argument('--spectra', help='spectra CSV/.npz of the device, for C and K')
+    parser.add_argument('--iv', help='IV+photocurrent CSV/.npz of the device')
+    parser.add_argument('--index', type=int, help='voltage index of the spectrum to use (default: max luminance)')
+    parser.add_argument('--factor', type=float, help='cd.m-2 per mA of photocurrent, instead of --spectra/--iv')
+    parser.add_argument('--distance', type=float, default=pipeline.DEFAULT_D,
+                        help='distance between photodetector and LED (mm)')
+    parser.add_argument('--led-area', type=float, default=pipeline.DEFAULT_A_LED, help='active area of LED (mm^2)')
+    parser.add_argument('--pd-area', type=float, default=pipeline.DEFAULT_A_PHD,
+                        help='active area of photodetector (mm^2)')
+    parser.add_argument('-o', '--out', help="luminance output file (default: <log>_luminance.txt)")
+    parser.add_argument('-f', '--follow', action='store_true', help='keep reading as the log grows')
+    parser.add_argument('--interval', type=float, default=5.0, help='polling interval with --follow (s)')
+    parser.add_argument('--idle-timeout', type=float, help='stop following after this many seconds without data')
+    parser.add_argument('--window', type=int, default=10, help='rolling average window (samples)')
+    parser.add_argument('--baseline', type=int, default=5, help='initial samples fitted for L0')
+    args = parser.parse_args(argv)
+
+    if args.factor is not None:
+        factor = args.factor
+    elif args.spectra and args.iv:
+        result = pipeline.compute_metrics(args.spectra, args.iv,
+                                          geometry=pipeline.Geometry(args.distance, args.led_area, args.pd_area))
+        factor = luminance_factor(result, args.index)
+    else:
+        parser.error('give --spectra and --iv, or --factor')
+
+    out_path = args.out or os.path.splitext(args.log)[0] + '_luminance.txt'
+    tracker = process(args.log, factor, out_path, args.follow, args.interval, args.idle_timeout, args.window,
+                      args.baseline, callback=_report if args.follow else None)
+    _report(tracker)
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
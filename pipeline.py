@@ -0,0 +1,481 @@
+"""
+Headless QLED post-processing pipeline
+
+compute_metrics runs the whole calculation for one sample as a pure function
+(no Streamlit, no module state), so it can be cached, called from notebooks
+and run in worker processes. The app, batch.py and the other tools all go
+through it.
+"""
+
+import math
+import os
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+import calibrations
+import colorimetry
+import dataset
+import instrument
+import qsdat
+import spectral_engine
+import spectral_features
+import stack
+from results_table import ResultsTable
+from cache import LRUCache, content_hash
+from spectral_engine import e
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PHOTODIODE_FILE = os.path.join(HERE, 'PhotodiodeE_000.qsdat')
+PHOTOTOPIC_FILE = os.path.join(HERE, 'StranksPhototopicLuminosityFunction.csv')
+
+# Dataset behind the app's "USE DEFAULT FILES" button
+DEFAULT_SPECTRA_FILE = os.path.join(HERE, '2022-05-24Commercial_White1_spectra.csv')
+DEFAULT_IV_FILE = os.path.join(HERE, '2022-05-24Commercial_White1IV+photocurrent.csv')
+
+# Sidebar defaults of the app
+DEFAULT_D = 20.0       # mm, distance between photodetector and LED
+DEFAULT_A_LED = 15.0   # mm^2, active area of LED
+DEFAULT_A_PHD = 100.0  # mm^2, active area of photodetector
+
+# Luminance taken as the turn-on of the device [cd.m-2]
+TURN_ON_LUMINANCE = 1.0
+
+@instrument.timed('pipeline.read_spectra')
+def read_spectra(source):
+    # Spectra from a dataset (.npz) or the CSV written by spectra.py: wavelength column then one
+    # column per voltage. The CSV header and the integration-time footer are both '#' lines, so
+    # pandas' C parser can skip them without the slow skipfooter path.
+    # A stack directory is opened memory-mapped instead (a SpectralStack, indexed the same way).
+    if stack.is_stack(source):
+        return stack.open_stack(source)
+    if dataset.is_dataset(source):
+        return dataset.load_dataset(source).spectra_matrix()
+    import pandas as pd
+    return pd.read_csv(source, sep='\t', header=None, comment='#', float_precision='round_trip').to_numpy()
+
+
+@instrument.timed('pipeline.read_iv')
+def read_iv(source):
+    # IV+photocurrent from a dataset (.npz) or the CSV written by el.py: V, I (mA), Iphd (mA), ...
+    if dataset.is_dataset(source):
+        return dataset.load_dataset(source).iv_matrix()
+    import pandas as pd
+    return pd.read_csv(source, sep='\t', header=None, comment='#', float_precision='round_trip').to_numpy()
+
+
+def read_reference_tables(photodiode_file=PHOTODIODE_FILE, phototopic_file=PHOTOTOPIC_FILE):
+    return read_calibration(photodiode_file), read_phototopic(phototopic_file)
+
+
+@instrument.timed('pipeline.read_calibration')
+def read_calibration(source):
+    # Photodiode calibration table (.qsdat or tab-separated export, or a registry name), parsed once
+    # and then served from the calibration cache
+    return calibrations.load(source).data
+
+
+@instrument.timed('pipeline.read_phototopic')
+def read_phototopic(source):
+    import pandas as pd
+    return pd.read_csv(source, header=None).to_numpy()
+
+
+def _as_array(source, reader):
+    # Arrays pass through, anything else (path, upload, QsdatFile, Calibration) is read
+    if isinstance(source, (qsdat.QsdatFile, calibrations.Calibration)):
+        return source.data
+    if isinstance(source, (np.ndarray, stack.SpectralStack)):
+        return source
+    if hasattr(source, 'seek'):
+        # Uploads may have been read already (e.g. hashed or parsed on an earlier rerun)
+        source.seek(0)
+    return reader(source)
+
+
+def solid_angle(D, A_phd):
+    # Angle subtended by the photodetector [sr]
+    return 2*math.pi*(1-math.cos(math.sqrt(A_phd/math.pi)/D))
+
+
+@dataclass(frozen=True)
+class Geometry:
+    D: float = DEFAULT_D          # mm, distance between photodetector and LED
+    A_LED: float = DEFAULT_A_LED  # mm^2, active area of LED
+    A_phd: float = DEFAULT_A_PHD  # mm^2, active area of photodetector
+
+    @property
+    def Omega_phd(self):
+        return solid_angle(self.D, self.A_phd)
+
+
+@dataclass
+class SpectralIntegrals:
+    """
+    Spectrum-dependent stage: depends only on the spectra and the reference
+    tables, not on the geometry or the IV data.
+
+    Spectra: (nbins, 1+nspectra) wavelength column then one column per voltage
+             (an array, or a memory-mapped SpectralStack indexed the same way)
+    normalized_spectra: Spectra with every column but the 0V one scaled to max 1
+                        (a lazy NormalizedStack for stacks)
+    Cs, Ks, E_photon: spectral integrals for every spectrum column
+    XYZ: (3, nspectra) CIE 1931 tristimulus values (relative)
+    color: colorimetry.FIELDS (chromaticity, CCT, dominant wavelength) for every spectrum column
+    features: spectral_features.FIELDS (peak, FWHM, centroid, integrated counts) for every
+              spectrum column
+    """
+    Spectra: object
+    normalized_spectra: object
+    Cs: np.ndarray
+    Ks: np.ndarray
+    E_photon: np.ndarray
+    XYZ: np.ndarray
+    color: dict
+    features: dict
+    photodiode_data: np.ndarray
+    phototopic: np.ndarray
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.Spectra, self.normalized_spectra, self.Cs, self.Ks, self.E_photon,
+                                      self.XYZ, self.photodiode_data, self.phototopic, *self.color.values(),
+                                      *self.features.values()))
+
+
+@dataclass
+class Result:
+    """
+    Output of compute_metrics: the spectral stage plus the per-voltage
+    ResultsTable (V, I, Iphd, photon flux, radiance, EQE, J, luminous
+    intensity, luminance, current and luminous efficacy) for one geometry.
+    key identifies the inputs (content hashes and geometry) when the result
+    comes from cached_compute_metrics, and is None otherwise. calibration is
+    the provenance of the photodiode calibration used (see calibrations.py).
+    """
+    spectral: SpectralIntegrals
+    table: ResultsTable
+    geometry: Geometry
+    key: tuple = None
+    calibration: dict = None
+
+    @property
+    def numpoints(self):
+        return len(self.table)
+
+    @property
+    def Spectra(self):
+        return self.spectral.Spectra
+
+    @property
+    def normalized_spectra(self):
+        return self.spectral.normalized_spectra
+
+    @property
+    def wavelengths(self):
+        return self.spectral.Spectra[:, 0]
+
+    @property
+    def Cs(self):
+        return self.spectral.Cs[:self.numpoints]
+
+    @property
+    def Ks(self):
+        return self.spectral.Ks[:self.numpoints]
+
+    @property
+    def E_photon(self):
+        return self.spectral.E_photon[:self.numpoints]
+
+    @property
+    def photodiode_data(self):
+        return self.spectral.photodiode_data
+
+    @property
+    def phototopic(self):
+        return self.spectral.phototopic
+
+    @property
+    def nbytes(self):
+        return self.spectral.nbytes + self.table.nbytes
+
+
+def normalize_spectra(Spectra):
+    # The 0V column is entirely zeros and is left as it is
+    normalized = Spectra.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized[:, 2:] = Spectra[:, 2:]/np.amax(Spectra[:, 2:], axis=0)
+    return normalized
+
+
+@instrument.timed('pipeline.spectral_stage')
+def spectral_stage(Spectra, photodiode_data, phototopic):
+    # C, K and E_photon for every spectrum column (the expensive part)
+    wavelengths = Spectra[:, 0]
+    with instrument.stage('pipeline.calibration_resample'):
+        detector_qe = calibrations.detector_qe_on_grid(wavelengths, photodiode_data)
+        phototopic_response, phototopic_inside = spectral_engine.phototopic_on_grid(wavelengths, phototopic)
+    if isinstance(Spectra, stack.SpectralStack):
+        # Stacks are walked in bounded blocks; C, K, E_photon and the chromaticity don't depend
+        # on the normalization, so the raw blocks are integrated in a single pass over the file,
+        # which also extracts the peak features and the column maxima of the lazy normalized view.
+        XYZ, maxima, parts = np.empty((3, Spectra.nspectra)), np.empty(Spectra.nspectra), []
+        with instrument.stage('pipeline.spectral_integrals'):
+            Cs, Ks, E_photon = spectral_engine.spectral_integrals_chunked(
+                wavelengths, _per_spectrum(wavelengths, Spectra.iter_chunks(), XYZ, maxima, parts),
+                Spectra.nspectra, detector_qe, phototopic_response, phototopic_inside)
+        features = {name: np.concatenate([part[name] for part in parts]) for name in spectral_features.FIELDS}
+        normalized = stack.NormalizedStack(Spectra, maxima)
+    else:
+        normalized = normalize_spectra(Spectra)
+        with instrument.stage('pipeline.spectral_integrals'):
+            Cs, Ks, E_photon = spectral_engine.spectral_integrals(
+                wavelengths, normalized[:, 1:], detector_qe, phototopic_response, phototopic_inside)
+            XYZ = colorimetry.tristimulus(wavelengths, normalized[:, 1:])
+        with instrument.stage('pipeline.spectral_features'):
+            features = spectral_features.extract(wavelengths, Spectra[:, 1:])
+    # Chromaticity only for columns with real emission: those spectral_features found a peak in
+    lit = np.isfinite(features['peak_wavelength'])
+    return SpectralIntegrals(Spectra=Spectra, normalized_spectra=normalized, Cs=Cs, Ks=Ks, E_photon=E_photon,
+                             XYZ=XYZ, color=colorimetry.color_coordinates(XYZ, lit=lit), features=features,
+                             photodiode_data=photodiode_data, phototopic=phototopic)
+
+
+def _per_spectrum(wavelengths, chunks, XYZ, maxima, parts):
+    # Pass chunks through, filling XYZ and maxima and appending the features of each block to parts on the way
+    W = colorimetry.cmf_weights(wavelengths)
+    for start, block in chunks:
+        XYZ[:, start:start+block.shape[1]] = W @ block
+        maxima[start:start+block.shape[1]] = np.amax(block, axis=0)
+        parts.append(spectral_features.extract(wavelengths, block))
+        yield start, block
+
+
+@instrument.timed('pipeline.geometry_stage')
+def geometry_stage(spectral, IV, geometry):
+    # ResultsTable from the cached spectral integrals: scalar rescaling only
+    numpoints = len(IV)
+    Cs = spectral.Cs[:numpoints]
+    Ks = spectral.Ks[:numpoints]
+    E_photon = spectral.E_photon[:numpoints]
+
+    Omega_phd = geometry.Omega_phd
+    A_LED = geometry.A_LED
+
+    table = ResultsTable(numpoints)
+    table['V'] = IV[:, 0]
+    table['I'] = IV[:, 1]
+    table['Iphd'] = IV[:, 2]
+    V, I, Iphd = table['V'], table['I'], table['Iphd']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Phi_phd = table['photon_flux']
+        Phi_phd[:] = Iphd/(1000*Omega_phd*Cs*e)               # [photons.s-1.sr-1]
+        table['radiance'] = Phi_phd*E_photon/(A_LED*1e-6)     # [W.sr-1.m-2]
+        table['EQE'] = math.pi*Phi_phd/(I/(1000*e))*100       # Lambertian emission [%]
+        table['J'] = I/(A_LED*1e-2)                           # [mA.cm-2]
+        table['luminous_intensity'] = Phi_phd*Ks              # [cd]
+        table['luminance'] = table['luminous_intensity']/(A_LED*1e-6)  # [cd.m-2]
+        table['current_efficacy'] = Ks*Iphd/(e*I*Cs*Omega_phd)        # [cd.A-1]
+        table['luminous_efficacy'] = math.pi*Ks*Iphd*1e-3/(e*Cs*Omega_phd*V*I*1e-3)  # [lm.W-1]
+    for name in colorimetry.FIELDS:
+        table[name] = spectral.color[name][:numpoints]
+    for name in spectral_features.FIELDS:
+        table[name] = spectral.features[name][:numpoints]
+    return table
+
+
+@instrument.timed('pipeline.compute_metrics')
+def compute_metrics(spectra, iv, calibration=PHOTODIODE_FILE, phototopic=PHOTOTOPIC_FILE,
+                    geometry=Geometry()):
+    """
+    Run the whole post-processing for one sample.
+
+    spectra, iv: arrays or paths/file objects of the spectra and
+                 IV+photocurrent CSVs
+    calibration: photodiode table, QsdatFile, Calibration, registry name or path
+    phototopic: phototopic table or path
+    geometry: Geometry of the setup
+
+    Has no side effects; returns a Result.
+    """
+    Spectra = _as_array(spectra, read_spectra)
+    IV = _as_array(iv, read_iv)
+    photodiode_data = _as_array(calibration, read_calibration)
+    phototopic = _as_array(phototopic, read_phototopic)
+
+    spectral = spectral_stage(Spectra, photodiode_data, phototopic)
+    return Result(spectral, geometry_stage(spectral, IV, geometry), geometry,
+                  calibration=calibrations.provenance(calibration))
+
+
+# Stage caches kept across Streamlit reruns and sessions, keyed on input contents:
+# parsed inputs, spectral integrals, and final results (which add the geometry).
+# A final result is memoized as its geometry table plus the key of its spectral
+# integrals, so it never keeps integrals alive after _spectral has evicted them.
+MEMO_ENTRIES = 16
+MEMO_BYTES = 512*2**20
+
+_parsed = LRUCache(4*MEMO_ENTRIES, MEMO_BYTES, sizeof=lambda a: a.nbytes)
+_spectral = LRUCache(MEMO_ENTRIES, MEMO_BYTES, sizeof=lambda spectral: spectral.nbytes)
+_memo = LRUCache(4*MEMO_ENTRIES, MEMO_BYTES, sizeof=lambda entry: entry[1].nbytes)
+
+
+def _memo_get(key):
+    # Result for key from its memoized table and the integrals still cached (shared or in _spectral)
+    entry = _memo.get(key)
+    if entry is None:
+        return None
+    spectral_key, table, calibration = entry
+    spectral = _shared.get(('spectral',) + spectral_key) or _spectral.get(spectral_key)
+    if spectral is None:
+        return None
+    return Result(spectral, table, key[-1], key, calibration)
+
+
+def _memo_put(result, spectral_key):
+    _memo.put(result.key, (spectral_key, result.table, result.calibration))
+
+
+def _cached_array(digest, source, reader):
+    array = _parsed.get(digest)
+    if array is None:
+        array = _as_array(source, reader)
+        _parsed.put(digest, array)
+    return array
+
+
+@instrument.timed('pipeline.cached_compute_metrics')
+def cached_compute_metrics(spectra, iv, calibration=PHOTODIODE_FILE, phototopic=PHOTOTOPIC_FILE,
+                           geometry=Geometry()):
+    """
+    compute_metrics with every stage memoized on the content hash of its
+    inputs. A new geometry only reruns geometry_stage on the cached spectral
+    integrals. The returned Result is shared between callers: do not modify it.
+    """
+    calibration = calibrations.resolve(calibration)
+    h_spectra, h_iv = content_hash(spectra), content_hash(iv)
+    h_cal, h_phot = content_hash(calibration), content_hash(phototopic)
+    key = (h_spectra, h_iv, h_cal, h_phot, geometry)
+    result = _shared.get(key) or _memo_get(key)
+    if result is not None:
+        return result
+
+    spectral_key = (h_spectra, h_cal, h_phot)
+    spectral = _shared.get(('spectral',) + spectral_key) or _spectral.get(spectral_key)
+    if spectral is None:
+        spectral = spectral_stage(_cached_array(h_spectra, spectra, read_spectra),
+                                  _cached_array(h_cal, calibration, read_calibration),
+                                  _cached_array(h_phot, phototopic, read_phototopic))
+        _spectral.put(spectral_key, spectral)
+
+    IV = _cached_array(h_iv, iv, read_iv)
+    result = Result(spectral, geometry_stage(spectral, IV, geometry), geometry, key,
+                    calibrations.provenance(calibration))
+    _memo_put(result, spectral_key)
+    return result
+
+
+# Process-wide resources shared read-only by every session: the reference tables and the default
+# dataset's parsed inputs, spectral integrals and default-geometry result. Each is loaded once
+# (concurrent first requests wait for the one load instead of repeating it), never evicted, and
+# its arrays are made read-only so no caller can change them under the others.
+_shared = {}
+_shared_lock = threading.RLock()
+
+
+def shared(key, load):
+    value = _shared.get(key)
+    if value is None:
+        with _shared_lock:
+            value = _shared.get(key)
+            if value is None:
+                value = load()
+                _freeze(value)
+                _shared[key] = value
+    return value
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, Result):
+        _freeze(value.spectral)
+        _freeze(value.table._block)
+    elif isinstance(value, SpectralIntegrals):
+        for a in (value.Spectra, value.normalized_spectra, value.Cs, value.Ks, value.E_photon, value.XYZ,
+                  value.photodiode_data, value.phototopic, *value.color.values(), *value.features.values()):
+            _freeze(a)
+
+
+def reference_phototopic():
+    return shared(('phototopic', content_hash(PHOTOTOPIC_FILE)), lambda: read_phototopic(PHOTOTOPIC_FILE))
+
+
+def reference_calibration(calibration=calibrations.DEFAULT):
+    # Table of a registered calibration (name, path or Calibration)
+    calibration = calibrations.resolve(calibration)
+    return shared(('calibration', content_hash(calibration)), lambda: _as_array(calibration, read_calibration))
+
+
+@instrument.timed('pipeline.default_result')
+def default_result(geometry=Geometry(), calibration=calibrations.DEFAULT):
+    """
+    Result of the default dataset, as cached_compute_metrics would return it
+    (same key), with the inputs and spectral integrals shared by every
+    session for the registered calibrations, and the default-geometry result
+    itself shared too. Other geometries only add a small table to the memo.
+    """
+    calibration = calibrations.resolve(calibration)
+    h_cal = content_hash(calibration)
+    if h_cal not in {content_hash(path) for path in calibrations.REGISTRY.values()}:
+        # Uploaded calibrations are not kept for the lifetime of the server
+        return cached_compute_metrics(DEFAULT_SPECTRA_FILE, DEFAULT_IV_FILE, calibration, geometry=geometry)
+    h_spectra, h_iv, h_phot = content_hash(DEFAULT_SPECTRA_FILE), content_hash(DEFAULT_IV_FILE), \
+        content_hash(PHOTOTOPIC_FILE)
+    key = (h_spectra, h_iv, h_cal, h_phot, geometry)
+    result = _shared.get(key) or _memo_get(key)
+    if result is not None:
+        return result
+
+    def build():
+        spectral = shared(('spectral', h_spectra, h_cal, h_phot), lambda: spectral_stage(
+            shared(('spectra', h_spectra), lambda: read_spectra(DEFAULT_SPECTRA_FILE)),
+            reference_calibration(calibration), reference_phototopic()))
+        IV = shared(('iv', h_iv), lambda: read_iv(DEFAULT_IV_FILE))
+        return Result(spectral, geometry_stage(spectral, IV, geometry), geometry, key,
+                      calibrations.provenance(calibration))
+
+    if geometry == Geometry():
+        return shared(key, build)
+    result = build()
+    _memo_put(result, (h_spectra, h_cal, h_phot))
+    return result
+
+
+def summarize(table, turn_on_luminance=TURN_ON_LUMINANCE):
+    # Headline figures of merit for one sweep. Peaks are taken from the
+    # turn-on voltage (first point reaching turn_on_luminance) upwards, since
+    # below it the ratios are dominated by noise on near-zero currents.
+    V = table['V']
+    lit = np.nonzero(table['luminance'] >= turn_on_luminance)[0]
+    start = lit[0] if len(lit) else len(V)
+
+    def peak(name):
+        values = table[name][start:]
+        if np.all(np.isnan(values)):
+            return math.nan, math.nan
+        i = np.nanargmax(values)
+        return float(values[i]), float(V[start+i])
+
+    peak_eqe, peak_eqe_voltage = peak('EQE')
+    return {
+        'numpoints': len(V),
+        'turn_on_voltage(V)': float(V[start]) if len(lit) else math.nan,
+        'peak_EQE(%)': peak_eqe,
+        'peak_EQE_voltage(V)': peak_eqe_voltage,
+        'max_luminance(cd.m-2)': peak('luminance')[0],
+        'max_current_efficacy(cd.A-1)': peak('current_efficacy')[0],
+        'max_luminous_efficacy(lm.W-1)': peak('luminous_efficacy')[0],
+    }
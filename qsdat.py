@@ -0,0 +1,112 @@
+"""
+Reader for QE-system calibration files
+
+Parses .qsdat exports (START HEADER / START DATA / START FOOTER blocks) in a
+single pass over the lines, without writing any intermediate files. The
+plain tab-separated export (a column-name row followed by data, as in
+Si_Diode_MZ_000.txt) is read by the same entry point.
+"""
+
+import io
+import os
+
+import numpy as np
+
+
+class QsdatFile:
+    """
+    Parsed calibration file.
+
+    header, footer: dict of the key/value lines with quotes removed
+                    (e.g. header['StartWavelength'] == '300')
+    columns: column names of the data block, e.g. 'Wavelength(λ)', 'EQE(%)'
+    data: (nrows, ncolumns) float array
+    """
+
+    def __init__(self, header, columns, data, footer):
+        self.header = header
+        self.columns = columns
+        self.data = data
+        self.footer = footer
+
+    def column(self, prefix):
+        # Data column whose name starts with prefix, e.g. column('SR')
+        for i, name in enumerate(self.columns):
+            if name.startswith(prefix):
+                return self.data[:, i]
+        raise KeyError(prefix)
+
+
+def _lines(source):
+    # Text lines from a path, a text stream or a binary stream (e.g. an upload)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'r', encoding='utf-8', errors='replace') as f:
+            yield from f
+        return
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    if isinstance(source.read(0), bytes):
+        text = io.TextIOWrapper(source, encoding='utf-8', errors='replace')
+        try:
+            yield from text
+        finally:
+            # Leave the caller's stream open
+            text.detach()
+        return
+    yield from source
+
+
+def _key_value(line):
+    key, _, value = line.partition('\t')
+    return key.strip().rstrip(':'), value.strip().strip('"')
+
+
+def _rows_to_array(rows, ncolumns):
+    if not rows:
+        return np.zeros((0, ncolumns))
+    return np.loadtxt(rows, delimiter='\t', ndmin=2)
+
+
+def read_calibration(source):
+    """
+    Read a .qsdat file or a plain tab-separated calibration table.
+
+    source: path, or file-like object in text or binary mode
+    Returns a QsdatFile; the plain format has empty header/footer dicts.
+    """
+    header = {}
+    footer = {}
+    columns = None
+    rows = []
+
+    section = None
+    for line in _lines(source):
+        line = line.rstrip('\r\n')
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if stripped.startswith('START HEADER'):
+            section = 'header'
+        elif stripped.startswith('START DATA'):
+            section = 'columns'
+        elif stripped.startswith('START FOOTER'):
+            section = 'footer'
+        elif stripped.startswith('END '):
+            section = None
+        elif section == 'header':
+            key, value = _key_value(line)
+            header[key] = value
+        elif section == 'footer':
+            key, value = _key_value(line)
+            footer[key] = value
+        elif section == 'columns' or (section is None and columns is None):
+            # First row of the data block (or of a plain table) names the columns
+            columns = [name.strip() for name in line.split('\t')]
+            section = 'data'
+        elif section == 'data':
+            rows.append(line)
+
+    if columns is None:
+        raise ValueError('no data block found in calibration file')
+    return QsdatFile(header, columns, _rows_to_array(rows, len(columns)), footer)
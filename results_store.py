@@ -0,0 +1,348 @@
+"""
+On-disk store of processed sweeps, for comparing many devices
+
+A store is a directory holding
+
+    index.sqlite   one row per sweep: sample, date, pixel, sweep range,
+                   processing parameters (D, A_LED, A_phd, calibration and
+                   phototopic files), the calibration's date and content
+                   hash, content hashes of the raw files and the figures of
+                   merit of pipeline.summarize
+    sweeps/        one dataset .npz per sweep (dataset.from_result: spectra,
+                   IV and every results column; spectra in a memory-mapped
+                   stack are recorded by path and content hash, not copied)
+
+Queries and aggregates run on the indexed SQLite table only; the sweep files
+are opened when the full curves are needed. A sample processed again with
+the same raw data and parameters replaces its previous row.
+
+    python results_store.py results.db query --sample 'Commercial*' --date-from 2022-05-01
+    python results_store.py results.db aggregate peak_EQE --by date
+"""
+
+import argparse
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import cache
+import dataset
+import pipeline
+
+
+# Figures of merit stored with every sweep: column name -> key of pipeline.summarize
+SUMMARY_COLUMNS = {
+    'turn_on_voltage': 'turn_on_voltage(V)',
+    'peak_EQE': 'peak_EQE(%)',
+    'peak_EQE_voltage': 'peak_EQE_voltage(V)',
+    'max_luminance': 'max_luminance(cd.m-2)',
+    'max_current_efficacy': 'max_current_efficacy(cd.A-1)',
+    'max_luminous_efficacy': 'max_luminous_efficacy(lm.W-1)',
+}
+
+# Columns query() filters on by equality
+KEY_COLUMNS = ('sample', 'date', 'pixel', 'sweep', 'D', 'A_LED', 'A_phd', 'calibration_file', 'calibration_hash',
+               'phototopic_file')
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    date TEXT NOT NULL,
+    pixel TEXT NOT NULL,
+    sweep TEXT NOT NULL,
+    D REAL NOT NULL,
+    A_LED REAL NOT NULL,
+    A_phd REAL NOT NULL,
+    calibration_file TEXT NOT NULL,
+    calibration_date TEXT,
+    calibration_hash TEXT NOT NULL,
+    phototopic_file TEXT NOT NULL,
+    spectra_hash TEXT NOT NULL,
+    iv_hash TEXT NOT NULL,
+    spectra_file TEXT,
+    iv_file TEXT,
+    sweep_file TEXT,
+    processed TEXT,
+    numpoints INTEGER,
+    {', '.join(f'{name} REAL' for name in SUMMARY_COLUMNS)},
+    UNIQUE (sample, date, spectra_hash, iv_hash, D, A_LED, A_phd, calibration_hash, phototopic_file)
+);
+CREATE INDEX IF NOT EXISTS sweeps_sample ON sweeps (sample);
+CREATE INDEX IF NOT EXISTS sweeps_date ON sweeps (date);
+CREATE INDEX IF NOT EXISTS sweeps_pixel ON sweeps (sample, pixel);
+CREATE INDEX IF NOT EXISTS sweeps_parameters ON sweeps (D, A_LED, A_phd, calibration_file);
+"""
+
+# Pixel label at the end of a sample name: ..._pixel3, ..._px3, ..._P3
+_PIXEL_RE = re.compile(r'[_-](?:pixel|px|p)(\d+)$', re.IGNORECASE)
+
+
+def pixel_of(sample):
+    m = _PIXEL_RE.search(sample)
+    return m.group(1) if m else ''
+
+
+def _source_name(source):
+    # Base name of a path or uploaded file, '' for arrays
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.basename(os.fspath(source).rstrip(os.sep))
+    return getattr(source, 'name', '') or ''
+
+
+class ResultsStore:
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        os.makedirs(os.path.join(self.path, 'sweeps'), exist_ok=True)
+        # Several batch workers may add sweeps at once; SQLite serializes the writes
+        self.connection = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, result, sample, date='', pixel=None, sweep='', spectra=None, iv=None,
+            phototopic=pipeline.PHOTOTOPIC_FILE):
+        """
+        Store a processed sweep and return its id. spectra and iv are the raw
+        inputs (paths or file objects), used for the content hashes that
+        identify the sweep; result.key is used instead when they are not given.
+        pixel defaults to the one at the end of the sample name (_P3, _pixel3).
+        The calibration is taken from result.calibration.
+        """
+        if spectra is not None and iv is not None:
+            spectra_hash, iv_hash = cache.content_hash(spectra), cache.content_hash(iv)
+        elif result.key is not None:
+            spectra_hash, iv_hash = result.key[:2]
+        else:
+            raise ValueError('spectra and iv are needed to identify a result not from cached_compute_metrics')
+        geometry = result.geometry
+        calibration = result.calibration or {}
+        summary = pipeline.summarize(result.table)
+        row = {
+            'sample': sample, 'date': date, 'pixel': pixel_of(sample) if pixel is None else str(pixel),
+            'sweep': sweep, 'D': geometry.D, 'A_LED': geometry.A_LED, 'A_phd': geometry.A_phd,
+            'calibration_file': calibration.get('file', ''), 'calibration_date': calibration.get('date', ''),
+            'calibration_hash': calibration.get('hash', ''), 'phototopic_file': _source_name(phototopic),
+            'spectra_hash': spectra_hash, 'iv_hash': iv_hash,
+            'spectra_file': _source_name(spectra), 'iv_file': _source_name(iv),
+            'processed': time.strftime('%Y-%m-%dT%H:%M:%S'), 'numpoints': summary['numpoints'],
+        }
+        row.update({name: _real(summary[key]) for name, key in SUMMARY_COLUMNS.items()})
+
+        names = list(row)
+        unique = ('sample', 'date', 'spectra_hash', 'iv_hash', 'D', 'A_LED', 'A_phd', 'calibration_hash',
+                  'phototopic_file')
+        # Upsert without ON CONFLICT/RETURNING, which need newer SQLite than some Python builds ship
+        with self.connection:
+            existing = self.connection.execute(
+                f"SELECT id FROM sweeps WHERE {' AND '.join(f'{name} = ?' for name in unique)}",
+                [row[name] for name in unique]).fetchone()
+            if existing is not None:
+                sweep_id = existing[0]
+                updated = [name for name in names if name not in unique]
+                self.connection.execute(
+                    f"UPDATE sweeps SET {', '.join(f'{name} = ?' for name in updated)} WHERE id = ?",
+                    [row[name] for name in updated] + [sweep_id])
+            else:
+                sweep_id = self.connection.execute(
+                    f"INSERT INTO sweeps ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                    [row[name] for name in names]).lastrowid
+            sweep_file = os.path.join('sweeps', f'{sweep_id:06d}{dataset.SUFFIX}')
+            metadata = {key: row[key] for key in ('sample', 'date', 'pixel', 'sweep', 'phototopic_file',
+                                                  'spectra_hash', 'iv_hash')}
+            # Written under a temporary name and renamed, so a reader never sees half a file
+            tmp = os.path.join(self.path, sweep_file + f'.{os.getpid()}.tmp{dataset.SUFFIX}')
+            dataset.save_dataset(tmp, dataset.from_result(result, metadata))
+            os.replace(tmp, os.path.join(self.path, sweep_file))
+            self.connection.execute('UPDATE sweeps SET sweep_file=? WHERE id=?', (sweep_file, sweep_id))
+        return sweep_id
+
+    def _where(self, filters):
+        # SQL condition and parameters for query(); '*' and '?' in text values match like shell globs
+        clauses, params = [], []
+        for name in KEY_COLUMNS:
+            value = filters.pop(name, None)
+            if value is None:
+                continue
+            if isinstance(value, str) and any(c in value for c in '*?['):
+                clauses.append(f'{name} GLOB ?')
+            else:
+                clauses.append(f'{name} = ?')
+            params.append(value)
+        date_from, date_to = filters.pop('date_from', None), filters.pop('date_to', None)
+        if date_from is not None:
+            clauses.append('date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append('date <= ?')
+            params.append(date_to)
+        for name in SUMMARY_COLUMNS:
+            for bound, op in (('min', '>='), ('max', '<=')):
+                value = filters.pop(f'{bound}_{name}', None)
+                if value is not None:
+                    clauses.append(f'{name} {op} ?')
+                    params.append(value)
+        if filters:
+            raise TypeError(f'unknown filters: {", ".join(sorted(filters))}')
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def query(self, order_by='date, sample, pixel', limit=None, **filters):
+        """
+        Stored sweeps as a list of dicts. Filters: any of KEY_COLUMNS (text
+        values may use * and ? wildcards), date_from, date_to, and
+        min_<name> / max_<name> for the SUMMARY_COLUMNS, e.g.
+        store.query(sample='White*', min_peak_EQE=10).
+        """
+        where, params = self._where(filters)
+        sql = f'SELECT * FROM sweeps{where}'
+        if order_by:
+            sql += ' ORDER BY ' + _order(order_by)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def aggregate(self, metric, by='sample', **filters):
+        """
+        count, mean, std, min and max of one SUMMARY_COLUMNS metric per group
+        of the by column(s) (e.g. 'sample', 'date', 'sample, pixel'), over the
+        sweeps matching the query() filters. NaN metrics are left out.
+        """
+        if metric not in SUMMARY_COLUMNS:
+            raise ValueError(f'unknown metric {metric!r}, expected one of {", ".join(SUMMARY_COLUMNS)}')
+        groups = [_column(name.strip()) for name in by.split(',')] if by else []
+        where, params = self._where(filters)
+        where += (' AND ' if where else ' WHERE ') + f'{metric} IS NOT NULL'
+        select = ', '.join(groups + [f'COUNT({metric}) AS count', f'AVG({metric}) AS mean',
+                                     f'AVG({metric}*{metric}) AS mean_square',
+                                     f'MIN({metric}) AS min', f'MAX({metric}) AS max'])
+        sql = f'SELECT {select} FROM sweeps{where}'
+        if groups:
+            sql += f" GROUP BY {', '.join(groups)} ORDER BY {', '.join(groups)}"
+        rows = []
+        for row in self.connection.execute(sql, params):
+            row = dict(row)
+            n, mean_square = row['count'], row.pop('mean_square')
+            # Sample standard deviation
+            variance = (mean_square - row['mean']**2)*n/(n-1) if n > 1 else math.nan
+            row['std'] = math.sqrt(max(variance, 0.0)) if n > 1 else math.nan
+            rows.append(row)
+        return rows
+
+    def load(self, sweep_id):
+        # Dataset of a stored sweep: spectra, IV and the 'results.<name>' columns
+        row = self.connection.execute('SELECT sweep_file FROM sweeps WHERE id=?', (sweep_id,)).fetchone()
+        if row is None:
+            raise KeyError(sweep_id)
+        return dataset.load_dataset(os.path.join(self.path, row['sweep_file']))
+
+    def remove(self, sweep_id):
+        row = self.connection.execute('SELECT sweep_file FROM sweeps WHERE id=?', (sweep_id,)).fetchone()
+        if row is None:
+            raise KeyError(sweep_id)
+        with self.connection:
+            self.connection.execute('DELETE FROM sweeps WHERE id=?', (sweep_id,))
+        try:
+            os.remove(os.path.join(self.path, row['sweep_file']))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM sweeps').fetchone()[0]
+
+
+_COLUMNS = set(KEY_COLUMNS) | set(SUMMARY_COLUMNS) | {'id', 'numpoints', 'processed', 'spectra_file', 'iv_file',
+                                                       'calibration_date'}
+
+
+def _column(name):
+    # Column names are interpolated into SQL, so only known ones are accepted
+    if name not in _COLUMNS:
+        raise ValueError(f'unknown column {name!r}')
+    return name
+
+
+def _order(order_by):
+    # 'date, peak_EQE desc' -> validated ORDER BY terms
+    terms = []
+    for term in order_by.split(','):
+        name, *direction = term.split()
+        if len(direction) > 1 or (direction and direction[0].upper() not in ('ASC', 'DESC')):
+            raise ValueError(f'bad order term {term.strip()!r}')
+        terms.append(' '.join([_column(name)] + [d.upper() for d in direction]))
+    return ', '.join(terms)
+
+
+def _real(value):
+    # NaN is stored as NULL
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+def _print_rows(rows, columns):
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join(_format(row[name]) for name in columns))
+
+
+def _format(value):
+    if value is None:
+        return 'nan'
+    if isinstance(value, float):
+        return f'{value:.6g}'
+    return str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query a QLED results store.')
+    parser.add_argument('store', help='results store folder')
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='list stored sweeps')
+    aggregate = commands.add_parser('aggregate', help='statistics of one figure of merit per group')
+    aggregate.add_argument('metric', choices=list(SUMMARY_COLUMNS))
+    aggregate.add_argument('--by', default='sample', help="group by these columns (default 'sample')")
+    for command in (query, aggregate):
+        command.add_argument('--sample', help="sample name, may contain * and ? (e.g. 'White*')")
+        command.add_argument('--pixel')
+        command.add_argument('--date-from', help='YYYY-MM-DD')
+        command.add_argument('--date-to', help='YYYY-MM-DD')
+        command.add_argument('--distance', type=float, dest='D')
+        command.add_argument('--led-area', type=float, dest='A_LED')
+        command.add_argument('--pd-area', type=float, dest='A_phd')
+        command.add_argument('--calibration', dest='calibration_file', help='calibration file name')
+    query.add_argument('--order-by', default='date, sample, pixel')
+    query.add_argument('--limit', type=int)
+    args = parser.parse_args(argv)
+
+    filters = {name: getattr(args, name) for name in ('sample', 'pixel', 'date_from', 'date_to', 'D', 'A_LED',
+                                                     'A_phd', 'calibration_file')}
+    with ResultsStore(args.store) as store:
+        if args.command == 'query':
+            columns = ['id', 'date', 'sample', 'pixel', 'sweep', 'D', 'A_LED', 'A_phd', 'calibration_file',
+                       'calibration_date'] + \
+                list(SUMMARY_COLUMNS)
+            _print_rows(store.query(args.order_by, args.limit, **filters), columns)
+        else:
+            groups = [name.strip() for name in args.by.split(',')] if args.by else []
+            _print_rows(store.aggregate(args.metric, args.by, **filters),
+                        groups + ['count', 'mean', 'std', 'min', 'max'])
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,96 @@
+"""
+Column-oriented results table for one voltage sweep
+
+All columns live in one preallocated (ncolumns, numpoints) block, so each
+column is a contiguous array that is filled in place and read by name
+instead of by position (table['luminance'] rather than IV_EL[:,8]).
+"""
+
+import numpy as np
+
+
+class Field:
+    def __init__(self, name, unit, label):
+        self.name = name
+        self.unit = unit
+        self.label = label
+
+    @property
+    def header(self):
+        # Column header used in exported files, e.g. 'Luminance(cd.m-2)'
+        return f'{self.label}({self.unit})'
+
+
+FIELDS = (
+    Field('V', 'V', 'Bias'),
+    Field('I', 'mA', 'Current'),
+    Field('Iphd', 'mA', 'Photocurrent'),
+    Field('photon_flux', 'photons.s-1.sr-1', 'PhotonFlux'),
+    Field('radiance', 'W.sr-1.m-2', 'Radiance'),
+    Field('EQE', '%', 'EQE'),
+    Field('J', 'mA.cm-2', 'CurrentDensity'),
+    Field('luminous_intensity', 'cd', 'LuminousIntensity'),
+    Field('luminance', 'cd.m-2', 'Luminance'),
+    Field('current_efficacy', 'cd.A-1', 'CurrentEfficacy'),
+    Field('luminous_efficacy', 'lm.W-1', 'LuminousEfficacy'),
+    Field('CIE_x', '-', 'CIEx'),
+    Field('CIE_y', '-', 'CIEy'),
+    Field('CIE_u', '-', "CIEu'"),
+    Field('CIE_v', '-', "CIEv'"),
+    Field('CCT', 'K', 'CCT'),
+    Field('dominant_wavelength', 'nm', 'DominantWavelength'),
+    Field('peak_wavelength', 'nm', 'PeakWavelength'),
+    Field('FWHM', 'nm', 'FWHM'),
+    Field('centroid', 'nm', 'Centroid'),
+    Field('integrated_counts', 'counts', 'IntegratedCounts'),
+)
+
+
+class ResultsTable:
+    """
+    table['EQE'] returns a view of the column; table['EQE'] = values copies
+    into the preallocated storage. Extra fields can be passed to the
+    constructor for derived columns.
+    """
+
+    def __init__(self, numpoints, fields=FIELDS):
+        self.fields = tuple(fields)
+        self._index = {field.name: i for i, field in enumerate(self.fields)}
+        self._block = np.zeros((len(self.fields), numpoints))
+
+    def __getitem__(self, name):
+        return self._block[self._index[name]]
+
+    def __setitem__(self, name, values):
+        self._block[self._index[name]] = values
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return self._block.shape[1]
+
+    @property
+    def names(self):
+        return [field.name for field in self.fields]
+
+    def unit(self, name):
+        return self.fields[self._index[name]].unit
+
+    @property
+    def nbytes(self):
+        return self._block.nbytes
+
+    def header(self, delimiter='\t'):
+        return delimiter.join(field.header for field in self.fields)
+
+    def to_array(self):
+        # (numpoints, ncolumns) copy, one row per voltage as in the exported files
+        return self._block.T.copy()
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame({field.header: self._block[i] for i, field in enumerate(self.fields)})
+
+    def to_csv(self, path, fmt='%.8e'):
+        np.savetxt(path, self._block.T, fmt=fmt, delimiter='\t', header=self.header())
@@ -16,24 +16,13 @@ Based off Steve Nichols' Script from ~2010, Univ. of California Santa Barbara
 #https://github.com/demisjohn/Keithley-I-V-Sweep
 
 
-import pyvisa        # PyVISA module, for GPIB comms
+import sys
 import numpy as np  # enable NumPy numerical analysis
 import time          # to allow pause between measurements
-import os            # Filesystem manipulation - mkdir, paths etc.
-import matplotlib.pyplot as plt # for python-style plottting, like 'ax1.plot(x,y)'
-import seabreeze
-seabreeze.use('pyseabreeze')
-from seabreeze.spectrometers import list_devices, Spectrometer
 from datetime import date
 
-import pandas as pd
-import math
-import matplotlib.cm as cm
-from matplotlib.colors import ListedColormap, LinearSegmentedColormap
-from IPython.display import Image
-import matplotlib as mpl
-from pylab import cm
-mpl.rcParams.update(mpl.rcParamsDefault)
+import dataset
+import stack
 
 import streamlit as st
 st.set_page_config(page_title='Spectra')
@@ -46,7 +35,12 @@ def intro():
 
 def set_params():
     with st.form("Set params"):
-        save_file_input = st.checkbox("Save files", value=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            save_file_input = st.checkbox("Save files", value=True)
+        with col2:
+            csv_input = st.checkbox("Also export CSV", value=True)
+        stack_input = st.checkbox("Also save the spectra as a memory-mapped stack (long runs)", value=False)
         sample_name_input = st.text_input("Sample name", value="Commercial_White1")
         
         col1, col2 = st.columns(2)
@@ -68,14 +62,33 @@ def set_params():
         submitted = st.form_submit_button("Run")
         if submitted:
             body(save_file_input, sample_name_input, sleep_time_input, current_compliance_input, 
-                 start_input, stop_input, numpoints_input, spec_int_time_input)
+                 start_input, stop_input, numpoints_input, spec_int_time_input, csv_input, stack_input)
             if save_file_input:
                 st.success('All files were downloaded!')
 
+def spectrometers():
+    #seabreeze is imported when a sweep is run, not to show the form. The backend can only be chosen
+    #before seabreeze.spectrometers is first loaded, and Streamlit reruns keep that module loaded.
+    if 'seabreeze.spectrometers' not in sys.modules:
+        import seabreeze
+        seabreeze.use('pyseabreeze')
+    from seabreeze import spectrometers
+    return spectrometers
+
+
 def body(save_file_input, sample_name_input, sleep_time_input, current_compliance_input, 
-         start_input, stop_input, numpoints_input, spec_int_time_input):
+         start_input, stop_input, numpoints_input, spec_int_time_input, csv_input=True, stack_input=False):
+    #Hardware drivers and plotting are only needed once a sweep is run
+    import pyvisa        # PyVISA module, for GPIB comms
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt # for python-style plottting, like 'ax1.plot(x,y)'
+    import matplotlib.cm as cm
+    mpl.rcParams.update(mpl.rcParamsDefault)
+
     #PARAMETERS
     SaveFiles = save_file_input   # Save the plot & data?  Only display if False.
+    ExportCSV = csv_input   # Write the CSV files next to the .npz dataset?
+    SaveStack = stack_input   # Write the spectra as a memory-mapped .stack folder too?
     Sample_Name = sample_name_input        #sample number
     sleep_time = sleep_time_input #seconds
     CurrentCompliance = current_compliance_input    # compliance (max) current (A)
@@ -91,10 +104,11 @@ def body(save_file_input, sample_name_input, sleep_time_input, current_complianc
     date_string = date.isoformat(today)
 #     date_string
 
-    devices = list_devices()
+    seabreeze_spectrometers = spectrometers()
+    devices = seabreeze_spectrometers.list_devices()
 #     devices
     
-    spec = Spectrometer(devices[0])
+    spec = seabreeze_spectrometers.Spectrometer(devices[0])
 #     spec
     
     # set integration time
@@ -192,6 +206,24 @@ def body(save_file_input, sample_name_input, sleep_time_input, current_complianc
 #     Spectra_array
     int_time_s = Spectrometer_integration_time/1000000
     if SaveFiles==True:
+        #Binary dataset with the spectra, the IV sweep and the acquisition settings
+        data = dataset.Dataset({'wavelengths': Spectra_array[:,0],
+                                'spectra_voltages': np.linspace(start, stop, num=numpoints, endpoint=True),
+                                'intensities': Spectra_array[:,1:],
+                                'voltage': Voltage[:,0], 'current': Current[:,0]},
+                               {'sample_name': Sample_Name, 'date': date_string, 'start_V': start, 'stop_V': stop,
+                                'numpoints': numpoints, 'integration_time_us': Spectrometer_integration_time,
+                                'sleep_time_s': sleep_time, 'current_compliance_A': CurrentCompliance})
+        dataset.save_dataset(f'IV+Spectra/{date_string}{Sample_Name}_{start}V-{stop}V_{int_time_s}s_spectra.npz', data)
+    if SaveFiles==True and SaveStack:
+        #Memory-mapped stack (stack.py): the post-processor and batch.py read it in bounded blocks
+        #instead of loading every spectrum, and prefer it to the dataset for the sample
+        stack.save_stack(f'IV+Spectra/{date_string}{Sample_Name}_{start}V-{stop}V_{int_time_s}s_spectra.stack',
+                         Spectra_array[:,0], Spectra_array[:,1:],
+                         np.linspace(start, stop, num=numpoints, endpoint=True),
+                         {'sample_name': Sample_Name, 'date': date_string, 'start_V': start, 'stop_V': stop,
+                          'numpoints': numpoints, 'integration_time_us': Spectrometer_integration_time})
+    if SaveFiles==True and ExportCSV:
         np.savetxt(f'IV+Spectra/{date_string}{Sample_Name}_{start}V-{stop}V_{int_time_s}s_spectra.csv', Spectra_array, 
                    fmt='%.18e', delimiter='\t', newline='\n', header=header_string, 
                    footer=f'Integration Time (ms) = {Spectrometer_integration_time}')
@@ -0,0 +1,90 @@
+"""
+Peak wavelength, FWHM, centroid and integrated counts of every spectrum
+
+All voltage columns of a spectra matrix are handled together with array
+operations (argmax, masked reductions), instead of one spectrum at a time.
+Columns without a real emission peak (the all-zero 0V column and the
+noise-only columns below turn-on) give NaN features rather than errors or
+meaningless numbers: a column counts as lit when its maximum stands
+MIN_SNR times above its noise level (median absolute deviation) and the
+peak is wider than a single bin.
+"""
+
+import numpy as np
+
+
+FIELDS = ('peak_wavelength', 'FWHM', 'centroid', 'integrated_counts')
+
+MIN_SNR = 5.0
+# The centroid only uses bins above this fraction of the peak, so the noise
+# floor across the whole spectrometer range does not pull it to the middle
+CENTROID_FRACTION = 0.05
+
+
+def noise_level(spectra):
+    # Robust standard deviation of each column (1.4826 x median absolute deviation)
+    median = np.median(spectra, axis=0)
+    return 1.4826*np.median(np.abs(spectra - median), axis=0)
+
+
+def _crossing(wavelengths, spectra, cols, i, level):
+    # Wavelength where the line between bins i and i+1 of each column crosses level
+    y0, y1 = spectra[i, cols], spectra[i+1, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip((level - y0)/(y1 - y0), 0.0, 1.0)
+    return wavelengths[i] + t*(wavelengths[i+1] - wavelengths[i])
+
+
+def extract(wavelengths, spectra, min_snr=MIN_SNR):
+    """
+    wavelengths: (nbins,) in nm; spectra: (nbins, nspectra) counts.
+
+    Returns a dict of (nspectra,) arrays:
+    peak_wavelength  nm, refined between bins by a parabola through the
+                     maximum and its neighbours
+    FWHM             nm, with the half-maximum crossings nearest to the
+                     peak interpolated linearly between bins; NaN when the
+                     peak runs off either end of the spectrum
+    centroid         nm, intensity-weighted mean wavelength
+    integrated_counts  sum of the counts of all bins (any column)
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    nbins, nspectra = spectra.shape
+    cols = np.arange(nspectra)
+    rows = np.arange(nbins)[:, None]
+
+    top = np.argmax(spectra, axis=0)
+    peak = spectra[top, cols]
+    half = peak/2
+
+    # Half-maximum crossings closest to the peak on each side
+    below = spectra < half
+    left = np.max(np.where(below & (rows < top), rows, -1), axis=0)
+    right = np.min(np.where(below & (rows > top), rows, nbins), axis=0)
+    lit = (peak > 0) & (peak > min_snr*noise_level(spectra)) & (right - left > 2)
+    has_left, has_right = left >= 0, right < nbins
+
+    # Parabolic refinement of the maximum (not at the ends of the spectrum)
+    inner = np.clip(top, 1, nbins-2)
+    y_lo, y_mid, y_hi = spectra[inner-1, cols], spectra[inner, cols], spectra[inner+1, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where((top == inner) & (y_lo - 2*y_mid + y_hi < 0),
+                          0.5*(y_lo - y_hi)/(y_lo - 2*y_mid + y_hi), 0.0)
+    position = top + np.clip(offset, -0.5, 0.5)
+    peak_wavelength = np.interp(position, np.arange(nbins), wavelengths)
+
+    left_wl = _crossing(wavelengths, spectra, cols, np.clip(left, 0, nbins-2), half)
+    right_wl = _crossing(wavelengths, spectra, cols, np.clip(right-1, 0, nbins-2), half)
+    fwhm = np.where(has_left & has_right, right_wl - left_wl, np.nan)
+
+    weights = np.where(spectra >= CENTROID_FRACTION*peak, spectra, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = (wavelengths @ weights)/np.sum(weights, axis=0)
+
+    return {
+        'peak_wavelength': np.where(lit, peak_wavelength, np.nan),
+        'FWHM': np.where(lit, fwhm, np.nan),
+        'centroid': np.where(lit, centroid, np.nan),
+        'integrated_counts': np.sum(spectra, axis=0),
+    }
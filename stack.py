@@ -0,0 +1,175 @@
+"""
+Memory-mapped stacks of spectra for long (lifetime, time-resolved) runs
+
+A stack is a directory holding
+
+    wavelengths.npy       (nbins,)
+    intensities.npy       (nbins, nspectra), column-major so each spectrum
+                          is contiguous on disk
+    spectra_voltages.npy  (nspectra,) optional
+    meta.json             acquisition metadata
+
+intensities.npy is memory-mapped, never loaded whole. SpectralStack indexes
+like the (nbins, 1+nspectra) Spectra matrix of the CSV files (column 0 is the
+wavelength), reading only the columns asked for, and iter_chunks() walks the
+spectra in blocks of bounded size. A stack pickles as its path, so worker
+processes reopen the memory map instead of receiving the spectra.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+SUFFIX = '.stack'
+
+# Upper bound on the size of one block handed out by iter_chunks
+CHUNK_BYTES = 64*2**20
+
+
+class SpectralStack:
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.wavelengths = np.load(os.path.join(self.path, 'wavelengths.npy'))
+        self.intensities = np.load(os.path.join(self.path, 'intensities.npy'), mmap_mode='r')
+        voltages = os.path.join(self.path, 'spectra_voltages.npy')
+        self.spectra_voltages = np.load(voltages) if os.path.exists(voltages) else None
+        meta = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta):
+            with open(meta, 'r') as f:
+                self.metadata = json.load(f)
+        else:
+            self.metadata = {}
+
+    def __reduce__(self):
+        return (SpectralStack, (self.path,))
+
+    @property
+    def nspectra(self):
+        return self.intensities.shape[1]
+
+    @property
+    def shape(self):
+        # Shape of the equivalent Spectra matrix
+        return (len(self.wavelengths), 1 + self.nspectra)
+
+    @property
+    def nbytes(self):
+        # Resident memory only; the intensities stay on disk
+        return self.wavelengths.nbytes
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    def __getitem__(self, key):
+        # Spectra-matrix indexing: stack[:, 0] is the wavelength, stack[:, k] spectrum k-1
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(cols, (int, np.integer)):
+            if cols < 0:
+                cols += self.shape[1]
+            if cols == 0:
+                return self.wavelengths[rows]
+            return np.asarray(self.intensities[rows, cols-1], dtype=float)
+        matrix_cols = np.arange(self.shape[1])[cols]
+        return np.column_stack([self[rows, int(k)] for k in matrix_cols])
+
+    def chunk_size(self, max_bytes=CHUNK_BYTES):
+        return max(1, int(max_bytes // (8*len(self.wavelengths))))
+
+    def iter_chunks(self, max_bytes=CHUNK_BYTES, stop=None):
+        # (start, block) with block a float64 (nbins, n) copy of spectra start:start+n; only the
+        # spectra before stop (all by default) are read
+        step = self.chunk_size(max_bytes)
+        stop = self.nspectra if stop is None else min(stop, self.nspectra)
+        for start in range(0, stop, step):
+            yield start, np.asarray(self.intensities[:, start:min(start+step, stop)], dtype=float)
+
+    def column_maxima(self, max_bytes=CHUNK_BYTES):
+        maxima = np.empty(self.nspectra)
+        for start, block in self.iter_chunks(max_bytes):
+            maxima[start:start+block.shape[1]] = np.amax(block, axis=0)
+        return maxima
+
+
+class NormalizedStack:
+    """
+    Lazy normalized view of a SpectralStack (same indexing), each spectrum
+    but the first (0V) one divided by its maximum.
+    """
+
+    def __init__(self, stack, maxima=None):
+        self.stack = stack
+        maxima = stack.column_maxima() if maxima is None else maxima
+        self.scale = np.ones(stack.nspectra)
+        with np.errstate(divide='ignore'):
+            self.scale[1:] = 1/maxima[1:]
+
+    @property
+    def nspectra(self):
+        return self.stack.nspectra
+
+    @property
+    def shape(self):
+        return self.stack.shape
+
+    @property
+    def nbytes(self):
+        return self.scale.nbytes
+
+    def __len__(self):
+        return len(self.stack)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(cols, (int, np.integer)):
+            if cols < 0:
+                cols += self.shape[1]
+            values = self.stack[rows, cols]
+            return values if cols == 0 else values*self.scale[cols-1]
+        matrix_cols = np.arange(self.shape[1])[cols]
+        return np.column_stack([self[rows, int(k)] for k in matrix_cols])
+
+    def chunk_size(self, max_bytes=CHUNK_BYTES):
+        return self.stack.chunk_size(max_bytes)
+
+    def iter_chunks(self, max_bytes=CHUNK_BYTES, stop=None):
+        for start, block in self.stack.iter_chunks(max_bytes, stop):
+            yield start, block*self.scale[start:start+block.shape[1]]
+
+
+def is_stack(source):
+    return isinstance(source, (str, os.PathLike)) and os.path.isdir(source) and \
+        os.path.exists(os.path.join(source, 'intensities.npy'))
+
+
+def open_stack(path):
+    return SpectralStack(path)
+
+
+def create_stack(path, wavelengths, nspectra, spectra_voltages=None, metadata=None):
+    """
+    New stack on disk with room for nspectra spectra. Returns the writable
+    memory map of the intensities, to be filled one spectrum (column) at a
+    time during acquisition; call .flush() when done.
+    """
+    path = os.fspath(path)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'wavelengths.npy'), np.asarray(wavelengths, dtype=float))
+    if spectra_voltages is not None:
+        np.save(os.path.join(path, 'spectra_voltages.npy'), np.asarray(spectra_voltages, dtype=float))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(metadata or {}, f)
+    return np.lib.format.open_memmap(os.path.join(path, 'intensities.npy'), mode='w+', dtype=np.float64,
+                                     shape=(len(wavelengths), nspectra), fortran_order=True)
+
+
+def save_stack(path, wavelengths, intensities, spectra_voltages=None, metadata=None, max_bytes=CHUNK_BYTES):
+    # Write an (nbins, nspectra) array (or another stack/memmap) as a stack, block by block
+    out = create_stack(path, wavelengths, intensities.shape[1], spectra_voltages, metadata)
+    step = max(1, int(max_bytes // (8*len(wavelengths))))
+    for start in range(0, intensities.shape[1], step):
+        out[:, start:start+step] = intensities[:, start:start+step]
+    out.flush()
+    del out
+    return os.fspath(path)
@@ -0,0 +1,96 @@
+"""
+Geometry parameter sweeps
+
+Evaluates Omega_phd, EQE, radiance and luminance over a whole grid of
+distances D, LED areas A_LED and detector areas A_phd in one broadcast
+computation, reusing the spectral integrals (C, K, E_photon) and IV data of
+a processed sweep. The geometry only enters as scale factors: EQE goes as
+1/Omega_phd, radiance and luminance as 1/(Omega_phd A_LED).
+"""
+
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+import instrument
+import pipeline
+from spectral_engine import e
+
+
+METRICS = ('EQE', 'radiance', 'luminance')
+
+
+def grid(lo, hi, steps):
+    # Values of one swept parameter; a single step gives lo
+    return np.linspace(lo, hi, max(1, int(steps))) if steps > 1 else np.array([float(lo)])
+
+
+@dataclass
+class GeometrySweep:
+    """
+    D, A_LED, A_phd: swept values (mm, mm^2, mm^2)
+    V: (numpoints,) bias
+    Omega_phd: (nD, nA_phd) solid angle of the detector [sr]
+    EQE, radiance, luminance: (nD, nA_LED, nA_phd, numpoints) values over the
+        grid (read-only broadcast views where a parameter doesn't matter)
+    """
+    D: np.ndarray
+    A_LED: np.ndarray
+    A_phd: np.ndarray
+    V: np.ndarray
+    Omega_phd: np.ndarray
+    EQE: np.ndarray
+    radiance: np.ndarray
+    luminance: np.ndarray
+
+    @property
+    def shape(self):
+        return (len(self.D), len(self.A_LED), len(self.A_phd))
+
+    def reduce(self, metric, voltage=None, turn_on_luminance=pipeline.TURN_ON_LUMINANCE):
+        """
+        (nD, nA_LED, nA_phd) map of one metric: its value at the bias closest
+        to voltage, or with voltage None its peak over the points at or above
+        the turn-on (luminance >= turn_on_luminance) of each geometry, as in
+        pipeline.summarize. NaN where the device never turns on.
+        """
+        values = getattr(self, metric)
+        if voltage is not None:
+            return values[..., int(np.nanargmin(np.abs(self.V - voltage)))]
+        # Points from the first lit one upwards, per geometry
+        lit = np.cumsum(self.luminance >= turn_on_luminance, axis=-1) > 0
+        with np.errstate(invalid='ignore'):
+            masked = np.where(lit, values, -np.inf)
+        peak = np.max(masked, axis=-1, initial=-np.inf)
+        return np.where(np.isfinite(peak), peak, np.nan)
+
+
+@instrument.timed('sweep.geometry_sweep')
+def geometry_sweep(result, D, A_LED, A_phd):
+    """
+    GeometrySweep of result over every combination of the D, A_LED and A_phd
+    values (1-D arrays). Matches pipeline.geometry_stage at each grid point.
+    """
+    D = np.atleast_1d(np.asarray(D, dtype=float))
+    A_LED = np.atleast_1d(np.asarray(A_LED, dtype=float))
+    A_phd = np.atleast_1d(np.asarray(A_phd, dtype=float))
+    table = result.table
+    I, Iphd = table['I'], table['Iphd']
+
+    # Per-voltage values for Omega_phd = 1 sr and A_LED = 1 mm^2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Phi_unit = Iphd/(1000*result.Cs*e)
+        EQE_unit = math.pi*Phi_unit/(I/(1000*e))*100
+        radiance_unit = Phi_unit*result.E_photon/1e-6
+        luminance_unit = Phi_unit*result.Ks/1e-6
+
+    Omega_phd = 2*np.pi*(1-np.cos(np.sqrt(A_phd[None, :]/np.pi)/D[:, None]))
+    shape = (len(D), len(A_LED), len(A_phd), len(I))
+    omega = Omega_phd[:, None, :, None]
+    area = A_LED[None, :, None, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        EQE = np.broadcast_to(EQE_unit/omega, shape)
+        radiance = radiance_unit/(omega*area)
+        luminance = luminance_unit/(omega*area)
+    return GeometrySweep(D, A_LED, A_phd, table['V'].copy(), Omega_phd, EQE, radiance, luminance)
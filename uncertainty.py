@@ -0,0 +1,187 @@
+"""
+Monte Carlo uncertainty of EQE and luminance
+
+Draws perturbed copies of the setup (distance D, areas A_LED and A_phd, the
+photodiode calibration scale and spectrometer noise) and evaluates C, K,
+Omega_phd, EQE and luminance for all draws and voltages as one broadcast
+computation, in blocks of voltages sized to a fixed memory budget. The
+spread of the draws gives a confidence band per voltage.
+
+Spectrometer noise enters the calculation only through the five spectral
+sums behind C, K and E_photon (spectral_engine.integral_weights), which are
+linear in the spectrum. Gaussian noise of standard deviation sigma in every
+bin therefore adds Gaussian noise of covariance sigma^2 W W^T to the sums,
+and that is drawn directly instead of perturbing all nbins of every spectrum
+(the same distribution, without the draws x voltages x nbins array).
+"""
+
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+import calibrations
+import instrument
+import spectral_engine
+import spectral_features
+import stack
+from cache import LRUCache
+from spectral_engine import e
+
+
+METRICS = ('EQE', 'luminance')
+
+# Upper bound on the working arrays of one block of voltages
+MAX_BYTES = 256*2**20
+
+# float64 arrays of shape (draws, voltages) alive at once in a block
+_ARRAYS_PER_POINT = 24
+
+
+@dataclass(frozen=True)
+class Uncertainties:
+    """
+    Standard deviations of the inputs and the Monte Carlo settings.
+
+    D: mm; A_LED, A_phd: mm^2
+    calibration: relative error of the photodiode QE (scale, same at every wavelength)
+    noise: spectrometer noise as a multiple of the noise estimated from the spectra
+    confidence: probability covered by the band
+    """
+    D: float = 0.5
+    A_LED: float = 0.5
+    A_phd: float = 2.0
+    calibration: float = 0.02
+    noise: float = 1.0
+    draws: int = 10000
+    confidence: float = 0.95
+    seed: int = 0
+
+
+@dataclass
+class Bands:
+    """
+    lower, median, upper: {metric: (numpoints,)} quantiles of the draws
+    std: {metric: (numpoints,)} standard deviation of the draws
+    """
+    lower: dict
+    median: dict
+    upper: dict
+    std: dict
+    settings: Uncertainties
+
+
+def spectral_sums(result):
+    # (5, numpoints) raw sums behind C, K and E_photon, plus the weights that give them
+    wavelengths = result.wavelengths
+    detector_qe = calibrations.detector_qe_on_grid(wavelengths, result.photodiode_data)
+    W = spectral_engine.integral_weights(wavelengths, detector_qe,
+                                         *spectral_engine.phototopic_on_grid(wavelengths, result.phototopic))
+    n = result.numpoints
+    Spectra = result.Spectra
+    if isinstance(Spectra, stack.SpectralStack):
+        sums, sigma = np.empty((len(W), n)), np.empty(n)
+        # Only the first numpoints spectra (one per voltage) are read, not the rest of the file
+        for start, block in Spectra.iter_chunks(stop=n):
+            sums[:, start:start+block.shape[1]] = W @ block[:-1]
+            sigma[start:start+block.shape[1]] = noise_sigma(block)
+    else:
+        spectra = np.asarray(Spectra[:, 1:n+1], dtype=float)
+        sums, sigma = W @ spectra[:-1], noise_sigma(spectra)
+    return W, sums, sigma
+
+
+def noise_sigma(spectra):
+    # Per-bin noise of each column: robust spread of bin-to-bin differences (insensitive to the peak)
+    return spectral_features.noise_level(np.diff(spectra, axis=0))/math.sqrt(2)
+
+
+def _sqrt_psd(matrix):
+    # L with L @ L.T == matrix for a positive semi-definite matrix
+    values, vectors = np.linalg.eigh(matrix)
+    return vectors*np.sqrt(np.clip(values, 0.0, None))
+
+
+@instrument.timed('uncertainty.propagate')
+def propagate(result, settings=Uncertainties(), metrics=METRICS, max_bytes=MAX_BYTES):
+    """
+    Bands of the metrics (ResultsTable names among EQE, luminance,
+    photon_flux, radiance, luminous_intensity, current_efficacy) from
+    settings.draws perturbed evaluations of result. Voltages where any draw
+    is not finite (dark spectra, zero current) get NaN.
+    """
+    rng = np.random.default_rng(settings.seed)
+    draws = settings.draws
+    geometry = result.geometry
+    # Per-draw setup, shared by every voltage; areas and distance stay positive
+    D = np.abs(geometry.D + settings.D*rng.standard_normal(draws))[:, None]
+    A_LED = np.abs(geometry.A_LED + settings.A_LED*rng.standard_normal(draws))[:, None]
+    A_phd = np.abs(geometry.A_phd + settings.A_phd*rng.standard_normal(draws))[:, None]
+    scale = (1 + settings.calibration*rng.standard_normal(draws))[:, None]
+    Omega_phd = 2*np.pi*(1-np.cos(np.sqrt(A_phd/np.pi)/D))
+
+    W, sums, sigma = spectral_sums(result)
+    L = _sqrt_psd(W @ W.T)
+    I, Iphd = result.table['I'], result.table['Iphd']
+
+    n = result.numpoints
+    q = (1-settings.confidence)/2
+    quantiles = {name: np.full((3, n), np.nan) for name in metrics}
+    std = {name: np.full(n, np.nan) for name in metrics}
+    step = max(1, int(max_bytes // (8*_ARRAYS_PER_POINT*draws)))
+    for start in range(0, n, step):
+        cols = slice(start, min(n, start+step))
+        with instrument.stage('uncertainty.block'):
+            # (draws, voltages, 5) perturbed sums
+            z = rng.standard_normal((draws, cols.stop-cols.start, len(W)))
+            perturbed = sums[:, cols].T + (settings.noise*sigma[cols])[:, None]*(z @ L.T)
+            del z
+            values = _metrics(perturbed, scale, Omega_phd, A_LED, I[cols], Iphd[cols])
+            for name in metrics:
+                x = values[name]
+                finite = np.isfinite(x).all(axis=0)
+                if finite.any():
+                    block = quantiles[name][:, cols]
+                    block[:, finite] = np.quantile(x[:, finite], (q, 0.5, 1-q), axis=0)
+                    std[name][cols][finite] = np.std(x[:, finite], axis=0)
+    return Bands({name: quantiles[name][0] for name in metrics}, {name: quantiles[name][1] for name in metrics},
+                 {name: quantiles[name][2] for name in metrics}, std, settings)
+
+
+def _metrics(sums, scale, Omega_phd, A_LED, I, Iphd):
+    # Same formulas as pipeline.geometry_stage, broadcast over (draws, voltages)
+    total, qe_weighted, energy_weighted, total_visible, lum_weighted = np.moveaxis(sums, -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Cs = scale*qe_weighted/total
+        Ks = lum_weighted/total_visible
+        Phi_phd = Iphd/(1000*Omega_phd*Cs*e)
+        return {
+            'photon_flux': Phi_phd,
+            'radiance': Phi_phd*(energy_weighted/total)/(A_LED*1e-6),
+            'EQE': math.pi*Phi_phd/(I/(1000*e))*100,
+            'luminous_intensity': Phi_phd*Ks,
+            'luminance': Phi_phd*Ks/(A_LED*1e-6),
+            'current_efficacy': Ks*Iphd/(e*I*Cs*Omega_phd),
+        }
+
+
+_memo = LRUCache(8)
+
+
+def cached_propagate(result, settings=Uncertainties(), metrics=METRICS):
+    # propagate() memoized on the result's inputs (results from cached_compute_metrics only)
+    if result.key is None:
+        return propagate(result, settings, metrics)
+    key = (result.key, settings, tuple(metrics))
+    bands = _memo.get(key)
+    if bands is None:
+        bands = propagate(result, settings, metrics)
+        _memo.put(key, bands)
+    return bands
+
+
+def relative_error(bands, metric):
+    # Half-width of the band relative to the median, per voltage
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (bands.upper[metric] - bands.lower[metric])/(2*bands.median[metric])
+
@@ -0,0 +1,226 @@
+"""
+Watch-folder ingest of new IV+Spectra measurements
+
+Polls the folder spectra.py and el.py save into (IV+Spectra/ by default),
+pairs new spectra and IV+photocurrent files the same way batch.py does, and
+processes each pair once its files have stopped changing, on a bounded pool
+of worker processes. The results table is written next to the raw data
+({date}{sample}_results.csv).
+
+A manifest (.qled_manifest.json in each watched folder) records, for every
+processed pair, a hash of the contents of its files and of the processing
+settings (geometry, calibration and phototopic table). Unchanged pairs are
+skipped, also after a restart; a pair is processed again if one of its files
+or any of the settings changes.
+
+    python watch.py IV+Spectra/ -j 2
+
+Does not import Streamlit.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import batch
+import cache
+import calibrations
+import pipeline
+
+
+MANIFEST = '.qled_manifest.json'
+
+# Seconds a file must stay unchanged before it is read (the instruments write in several steps)
+SETTLE = 2.0
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f'ignoring unreadable manifest {path}', file=sys.stderr)
+        return {}
+
+
+def save_manifest(directory, manifest):
+    # Written to a temporary file and renamed, so an interrupted write never loses the manifest
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def signature(path):
+    # (size, mtime) of a file, or of the newest file of a .stack directory
+    if os.path.isdir(path):
+        entries = [entry.stat() for entry in os.scandir(path)]
+        return (sum(st.st_size for st in entries), max((st.st_mtime_ns for st in entries), default=0))
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def settings_hash(geometry, photodiode_file, phototopic_file):
+    # Geometry and the contents of the calibration and phototopic table the results depend on
+    settings = (float(geometry.D), float(geometry.A_LED), float(geometry.A_phd),
+                calibrations.load(photodiode_file).digest, cache.content_hash(phototopic_file))
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+
+def pair_hash(spectra_path, iv_path, settings=''):
+    digest = f'{cache.content_hash(spectra_path)}:{cache.content_hash(iv_path)}'
+    return f'{digest}:{settings}' if settings else digest
+
+
+class Watcher:
+    """
+    State of the watch loop: the manifests of the watched folders and the
+    file signatures seen at the previous poll. poll() returns the pairs that
+    are ready to process: complete, unchanged for SETTLE seconds and not in
+    the manifest with the same content.
+    """
+
+    def __init__(self, directories, recursive=False, settle=SETTLE, settings=''):
+        self.directories = list(directories)
+        self.recursive = recursive
+        self.settle = settle
+        self.settings = settings    # settings_hash of the processing settings
+        self.manifests = {directory: load_manifest(directory) for directory in self.directories}
+        self._signatures = {}   # path -> (signature, time first seen with it)
+        self._known = {}        # (paths and signatures of a pair) -> its content hash
+        self.pending = set()    # names submitted and not yet finished
+
+    def _settled(self, path, now):
+        try:
+            sig = signature(path)
+        except OSError:
+            return None
+        previous = self._signatures.get(path)
+        if previous is None or previous[0] != sig:
+            self._signatures[path] = (sig, now)
+            return None
+        return sig if now - previous[1] >= self.settle else None
+
+    def poll(self):
+        now = time.monotonic()
+        ready = []
+        for directory in self.directories:
+            pairs, _ = batch.discover([directory], self.recursive)
+            for (date, sample), s_path, iv_path in pairs:
+                name = f'{date}{sample}'
+                if name in self.pending:
+                    continue
+                s_sig, iv_sig = self._settled(s_path, now), self._settled(iv_path, now)
+                if s_sig is None or iv_sig is None:
+                    continue
+                key = (s_path, s_sig, iv_path, iv_sig)
+                digest = self._known.get(key)
+                if digest is None:
+                    digest = self._known[key] = pair_hash(s_path, iv_path, self.settings)
+                entry = self.manifests[directory].get(name)
+                if entry is not None and entry.get('hash') == digest:
+                    continue
+                ready.append((directory, name, s_path, iv_path, digest))
+        return ready
+
+    def settling(self):
+        # True while a file seen by the last poll is still inside its settle period
+        now = time.monotonic()
+        return any(now - first_seen < self.settle for _, first_seen in self._signatures.values())
+
+    def record(self, directory, name, entry):
+        self.manifests[directory][name] = entry
+        save_manifest(directory, self.manifests[directory])
+
+
+def watch(directories, jobs=1, recursive=False, interval=5.0, settle=SETTLE, geometry=pipeline.Geometry(),
+          photodiode_file=calibrations.DEFAULT, phototopic_file=pipeline.PHOTOTOPIC_FILE, once=False,
+          store=None):
+    """
+    Watch loop. At most jobs pairs are processed at a time; new pairs wait
+    for a free worker. With once, processes what is there and returns.
+    store: results store folder (results_store.py) every sweep is added to.
+    """
+    watcher = Watcher(directories, recursive, settle, settings_hash(geometry, photodiode_file, phototopic_file))
+    futures = {}
+    with ProcessPoolExecutor(max_workers=max(1, jobs), initializer=batch._init_worker,
+                             initargs=(photodiode_file, phototopic_file)) as pool:
+        while True:
+            for directory, name, s_path, iv_path, digest in watcher.poll():
+                if len(futures) >= max(1, jobs):
+                    break
+                out_dir = os.path.dirname(os.path.abspath(s_path))
+                future = pool.submit(batch.process_pair, name, s_path, iv_path, out_dir,
+                                     geometry.D, geometry.A_LED, geometry.A_phd, store)
+                futures[future] = (directory, name, s_path, iv_path, digest)
+                watcher.pending.add(name)
+                print(f'processing {name}', flush=True)
+
+            if futures:
+                done, _ = wait(futures, timeout=interval, return_when=FIRST_COMPLETED)
+            elif once and not watcher.settling():
+                return watcher
+            else:
+                done = ()
+                time.sleep(min(interval, settle) if once else interval)
+            for future in done:
+                directory, name, s_path, iv_path, digest = futures.pop(future)
+                watcher.pending.discard(name)
+                entry = {'hash': digest, 'spectra_file': os.path.relpath(s_path, directory),
+                         'iv_file': os.path.relpath(iv_path, directory), 'processed': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                try:
+                    summary = future.result()
+                    entry['results_file'] = os.path.relpath(
+                        os.path.join(os.path.dirname(os.path.abspath(s_path)), f'{name}_results.csv'), directory)
+                    entry['summary'] = {k: v for k, v in summary.items()
+                                        if k not in ('sample', 'spectra_file', 'iv_file')}
+                    print(f'processed {name}', flush=True)
+                except Exception as err:
+                    # Recorded so the same files are not retried on every poll; changed files are
+                    entry['error'] = str(err)
+                    print(f'failed {name}: {err}', file=sys.stderr, flush=True)
+                watcher.record(directory, name, entry)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process new IV+Spectra measurements as they are saved.')
+    parser.add_argument('directories', nargs='*', default=['IV+Spectra'],
+                        help='folders spectra.py and el.py save into')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='number of worker processes')
+    parser.add_argument('-r', '--recursive', action='store_true', help='watch sub-folders too')
+    parser.add_argument('--interval', type=float, default=5.0, help='polling interval (s)')
+    parser.add_argument('--settle', type=float, default=SETTLE,
+                        help='seconds a file must be unchanged before it is processed')
+    parser.add_argument('--store', help='also add every sample to this results store folder (results_store.py)')
+    parser.add_argument('--once', action='store_true', help='process what is there now and exit')
+    parser.add_argument('--distance', type=float, default=pipeline.DEFAULT_D,
+                        help='distance between photodetector and LED (mm)')
+    parser.add_argument('--led-area', type=float, default=pipeline.DEFAULT_A_LED, help='active area of LED (mm^2)')
+    parser.add_argument('--pd-area', type=float, default=pipeline.DEFAULT_A_PHD,
+                        help='active area of photodetector (mm^2)')
+    parser.add_argument('--photodiode', default=calibrations.DEFAULT,
+                        help=f"photodiode calibration: file or one of {', '.join(calibrations.names())}")
+    parser.add_argument('--phototopic', default=pipeline.PHOTOTOPIC_FILE, help='phototopic function CSV')
+    args = parser.parse_args(argv)
+
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            parser.error(f'no such folder: {directory}')
+    watch(args.directories, args.jobs, args.recursive, args.interval, args.settle,
+          pipeline.Geometry(args.distance, args.led_area, args.pd_area), args.photodiode, args.phototopic, args.once,
+          args.store)
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(130)